@@ -0,0 +1,193 @@
+# app/alerts.py
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from sqlmodel import select
+from .models import SavedSearch, Notification
+from .db import get_session, as_float, normalize_link
+from .categories import canonicalize
+
+# Kubełki odwróconego indeksu zakresów
+PRICE_BUCKET = 10000     # PLN
+PRICE_MAX_BUCKET = 300   # ceny >= 3 mln PLN lądują w ostatnim kubełku
+YEAR_MIN_BUCKET = 1950
+YEAR_MAX_BUCKET = 2030
+
+CATEGORICAL = ("fuel_type", "gearbox", "voivodeship", "make", "model")
+ANY = None  # klucz „dowolna wartość” w indeksie kategorycznym
+
+
+def _price_bucket(price: float) -> int:
+    return max(0, min(PRICE_MAX_BUCKET, int(price // PRICE_BUCKET)))
+
+
+def _year_bucket(year: int) -> int:
+    return max(YEAR_MIN_BUCKET, min(YEAR_MAX_BUCKET, int(year)))
+
+
+class SavedSearchIndex:
+    """
+    Odwrócony indeks zapisanych wyszukiwań:
+      - klucze kategoryczne: wartość -> id wyszukiwań (ANY = wyszukiwania bez tego filtra),
+      - cena/rocznik: kubełek -> id wyszukiwań, których zakres pokrywa kubełek.
+    Dla ogłoszenia przecinamy zbiory kandydatów, a dokładne granice sprawdzamy tylko dla nich.
+    """
+
+    def __init__(self, searches: Iterable[SavedSearch]):
+        self.searches: Dict[int, SavedSearch] = {}
+        # id -> (price_min, price_max, year_min, year_max, mileage_max, power_min); brak filtra = ±inf
+        self.bounds: Dict[int, Tuple[float, ...]] = {}
+        # (kolumna, wartość) -> ANY ∪ wartość; liczone leniwie, czyszczone w add()
+        self._cat_cache: Dict[Tuple[str, str], Set[int]] = {}
+        self.cat: Dict[str, Dict[Optional[str], Set[int]]] = {c: defaultdict(set) for c in CATEGORICAL}
+        self.price: Dict[int, Set[int]] = defaultdict(set)
+        self.year: Dict[int, Set[int]] = defaultdict(set)
+        for ss in searches:
+            self.add(ss)
+
+    def add(self, ss: SavedSearch) -> None:
+        self.searches[ss.id] = ss
+        self._cat_cache.clear()
+        inf = float("inf")
+        self.bounds[ss.id] = tuple(
+            default if v is None else float(v)
+            for v, default in (
+                (ss.price_min, -inf), (ss.price_max, inf), (ss.year_min, -inf),
+                (ss.year_max, inf), (ss.mileage_max, inf), (ss.power_min, -inf),
+            )
+        )
+        for c in CATEGORICAL:
+            # etykiety kanoniczne – te same, które zwraca CarListing.<kolumna>
+            self.cat[c][canonicalize(c, getattr(ss, c)) or ANY].add(ss.id)
+        lo = _price_bucket(ss.price_min) if ss.price_min is not None else 0
+        hi = _price_bucket(ss.price_max) if ss.price_max is not None else PRICE_MAX_BUCKET
+        for b in range(lo, hi + 1):
+            self.price[b].add(ss.id)
+        lo = _year_bucket(ss.year_min) if ss.year_min is not None else YEAR_MIN_BUCKET
+        hi = _year_bucket(ss.year_max) if ss.year_max is not None else YEAR_MAX_BUCKET
+        for b in range(lo, hi + 1):
+            self.year[b].add(ss.id)
+
+    def _candidates(self, car) -> Set[int]:
+        sets = []
+        for c in CATEGORICAL:
+            v = getattr(car, c, None)
+            if not v:
+                sets.append(self.cat[c].get(ANY, set()))
+                continue
+            ids = self._cat_cache.get((c, v))
+            if ids is None:
+                ids = self._cat_cache[(c, v)] = self.cat[c].get(ANY, set()) | self.cat[c].get(v, set())
+            sets.append(ids)
+        price, year = as_float(car.price), as_float(car.year)
+        if price is not None:
+            sets.append(self.price.get(_price_bucket(price), set()))
+        if year is not None:
+            sets.append(self.year.get(_year_bucket(year), set()))
+        sets.sort(key=len)
+        return sets[0].intersection(*sets[1:])
+
+    def match(self, car) -> List[int]:
+        """Id zapisanych wyszukiwań, do których pasuje ogłoszenie (semantyka jak repo.search)."""
+        # brak wartości nie spełnia filtra – tak jak NULL w SQL (NaN porównuje się jako False)
+        nan = float("nan")
+        price, year, mileage, power = (
+            nan if v is None else v
+            for v in (as_float(car.price), as_float(car.year), as_float(car.mileage), as_float(car.power_hp))
+        )
+        inf = float("inf")
+        out = []
+        for sid in self._candidates(car):
+            p_lo, p_hi, y_lo, y_hi, m_hi, pw_lo = self.bounds[sid]
+            if p_lo != -inf or p_hi != inf:
+                if not p_lo <= price <= p_hi:
+                    continue
+            if y_lo != -inf or y_hi != inf:
+                if not y_lo <= year <= y_hi:
+                    continue
+            if m_hi != inf and not mileage <= m_hi:
+                continue
+            if pw_lo != -inf and not power >= pw_lo:
+                continue
+            out.append(sid)
+        return out
+
+
+_index: Optional[SavedSearchIndex] = None
+
+
+def get_index() -> SavedSearchIndex:
+    """Indeks budowany leniwie z tabeli savedsearch; unieważniany przy zmianach."""
+    global _index
+    if _index is None:
+        with get_session() as s:
+            _index = SavedSearchIndex(s.exec(select(SavedSearch)).all())
+    return _index
+
+
+def invalidate_index() -> None:
+    global _index
+    _index = None
+
+
+def create_saved_search(**fields) -> SavedSearch:
+    for c in CATEGORICAL:
+        fields[c] = canonicalize(c, fields.get(c))
+    with get_session() as s:
+        ss = SavedSearch(**fields)
+        s.add(ss)
+        s.commit()
+        s.refresh(ss)
+    if _index is not None:
+        _index.add(ss)
+    return ss
+
+
+def delete_saved_search(search_id: int, owner: str) -> bool:
+    with get_session() as s:
+        ss = s.get(SavedSearch, search_id)
+        if ss is None or ss.owner != owner:
+            return False
+        for n in s.exec(select(Notification).where(Notification.saved_search_id == search_id)):
+            s.delete(n)
+        s.delete(ss)
+        s.commit()
+    invalidate_index()
+    return True
+
+
+def list_saved_searches(owner: str) -> List[SavedSearch]:
+    with get_session() as s:
+        return s.exec(select(SavedSearch).where(SavedSearch.owner == owner)).all()
+
+
+def match_new_listings(delta: Iterable) -> int:
+    """
+    Dopasowuje deltę importu (nowe/zmienione ogłoszenia) do zapisanych wyszukiwań
+    i zapisuje powiadomienia. Zwraca liczbę utworzonych powiadomień.
+    """
+    index = get_index()
+    if not index.searches:
+        return 0
+    notes = []
+    for car in delta:
+        for sid in index.match(car):
+            notes.append(Notification(
+                saved_search_id=sid, owner=index.searches[sid].owner, link_key=normalize_link(car.link),
+                link=car.link, title=car.title, price=as_float(car.price),
+            ))
+    if notes:
+        with get_session() as s:
+            s.add_all(notes)
+            s.commit()
+    print(f"[alerts] Nowe powiadomienia: {len(notes)}")
+    return len(notes)
+
+
+def get_notifications(owner: str, since_id: int = 0, limit: int = 100) -> List[Notification]:
+    """Powiadomienia właściciela o id > since_id (do odpytywania przez klienta)."""
+    with get_session() as s:
+        q = (select(Notification)
+             .where(Notification.owner == owner, Notification.id > since_id)
+             .order_by(Notification.id.asc())
+             .limit(limit))
+        return s.exec(q).all()
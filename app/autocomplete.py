@@ -0,0 +1,176 @@
+# app/autocomplete.py
+import heapq
+import re
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import func
+from sqlmodel import Session, select
+from .models import CATEGORY_LABELS, CarListing
+from .categories import SYNONYMS, fold_diacritics, split_make_model
+
+TOP_K = 10          # najlepsze podpowiedzi trzymane w każdym węźle
+MIN_TYPO_LEN = 3    # krótsze zapytania bez tolerancji literówek
+
+# Podpowiedź: (rodzaj, kod) – rodzaj "make" albo "model"
+Entry = Tuple[str, int]
+
+
+class _Node:
+    __slots__ = ("children", "top")
+
+    def __init__(self):
+        self.children: Dict[str, "_Node"] = {}
+        self.top: List[Tuple[int, Entry]] = []  # (liczba ogłoszeń, wpis) – najliczniejsze z poddrzewa
+
+
+class PrefixIndex:
+    """
+    Drzewo prefiksowe znormalizowanych (bez diakrytyków, małe litery) tokenów marek i modeli.
+    Każdy węzeł przechowuje TOP_K wpisów z poddrzewa wg liczby ogłoszeń, więc odpowiedź
+    to przejście po długości zapytania; literówka (odległość edycyjna 1) rozgałęzia przejście.
+    """
+
+    def __init__(self):
+        self.root = _Node()
+
+    def add(self, key: str, entry: Entry, count: int) -> None:
+        node = self.root
+        self._push(node, entry, count)
+        for ch in key:
+            node = node.children.setdefault(ch, _Node())
+            self._push(node, entry, count)
+
+    @staticmethod
+    def _push(node: _Node, entry: Entry, count: int) -> None:
+        if any(e == entry for _, e in node.top):
+            return
+        node.top.append((count, entry))
+        if len(node.top) > TOP_K:
+            node.top.sort(key=lambda t: -t[0])
+            node.top.pop()
+
+    def _fuzzy_nodes(self, q: str) -> List[Tuple[int, _Node]]:
+        """Węzły, których ścieżka jest w odległości edycyjnej <= 1 od q: (liczba edycji, węzeł)."""
+        out: List[Tuple[int, _Node]] = []
+        allow = 1 if len(q) >= MIN_TYPO_LEN else 0
+        stack = [(self.root, 0, 0)]
+        seen = set()
+        while stack:
+            node, i, edits = stack.pop()
+            state = (id(node), i, edits)
+            if state in seen:
+                continue
+            seen.add(state)
+            if i == len(q):
+                out.append((edits, node))
+                continue
+            child = node.children.get(q[i])
+            if child is not None:
+                stack.append((child, i + 1, edits))
+            if edits < allow:
+                stack.append((node, i + 1, edits + 1))                  # nadmiarowy znak w zapytaniu
+                for ch, c in node.children.items():
+                    stack.append((c, i, edits + 1))                     # brakujący znak
+                    if ch != q[i]:
+                        stack.append((c, i + 1, edits + 1))             # zamiana znaku
+                if i + 1 < len(q):                                      # przestawienie sąsiednich
+                    c = node.children.get(q[i + 1])
+                    c = c.children.get(q[i]) if c is not None else None
+                    if c is not None:
+                        stack.append((c, i + 2, edits + 1))
+        return out
+
+    def complete(self, query: str, limit: int = TOP_K) -> List[Tuple[Entry, int, int]]:
+        """[(wpis, liczba ogłoszeń, liczba edycji)] – dokładne dopasowania przed literówkami."""
+        q = normalize(query)
+        if not q:
+            return []
+        best: Dict[Entry, Tuple[int, int]] = {}
+        for edits, node in self._fuzzy_nodes(q):
+            for count, entry in node.top:
+                if entry not in best or edits < best[entry][0]:
+                    best[entry] = (edits, count)
+        ranked = heapq.nsmallest(limit, best.items(), key=lambda kv: (kv[1][0], -kv[1][1]))
+        return [(entry, count, edits) for entry, (edits, count) in ranked]
+
+
+def normalize(text: str) -> str:
+    return re.sub(r"\s+", " ", fold_diacritics(text or "")).strip()
+
+
+_index: Optional[PrefixIndex] = None
+
+
+def build_autocomplete(session: Session) -> PrefixIndex:
+    """
+    Buduje indeks z liczności marek i modeli w carlisting (wywoływane po imporcie).
+    Model indeksowany jest pełną nazwą („toyota corolla”) i samym modelem („corolla”),
+    marka dodatkowo swoimi synonimami z categories.SYNONYMS.
+    """
+    global _index
+    index = PrefixIndex()
+    for column, kind in ((CarListing.make_id, "make"), (CarListing.model_id, "model")):
+        rows = session.exec(select(column, func.count()).where(column.is_not(None)).group_by(column)).all()
+        for code, count in rows:
+            label = CATEGORY_LABELS[kind].get(code)
+            if not label:
+                continue
+            key = normalize(label)
+            index.add(key, (kind, code), count)
+            if kind == "make":
+                # skróty/synonimy marek („vw”, „mercedes”) prowadzą do tej samej marki
+                for alias, canon in SYNONYMS["make"].items():
+                    if canon == label and normalize(alias) != key:
+                        index.add(normalize(alias), (kind, code), count)
+            if kind == "model":
+                make_key = normalize(_make_of(label) or "")
+                if make_key and key.startswith(make_key + " "):
+                    index.add(key[len(make_key) + 1:], (kind, code), count)
+    _index = index
+    return index
+
+
+def _make_of(model_label: str) -> Optional[str]:
+    """Marka modelu (etykieta modelu zaczyna się od nazwy marki)."""
+    return split_make_model(model_label)[0]
+
+
+def complete(query: str, limit: int = TOP_K) -> List[Dict]:
+    """Podpowiedzi marek/modeli dla wpisywanego tekstu, gotowe do użycia jako filtry repo.search."""
+    if _index is None:
+        return []
+    out = []
+    for (kind, code), count, edits in _index.complete(query, limit):
+        label = CATEGORY_LABELS[kind].get(code)
+        item = {"label": label, "kind": kind, "count": count, "typo": edits > 0}
+        if kind == "make":
+            item["filters"] = {"make": label}
+        else:
+            item["filters"] = {"make": _make_of(label), "model": label}
+        out.append(item)
+    return out
+
+
+def resolve_make_model(text: str) -> Dict[str, str]:
+    """
+    Marka/model wspomniane w swobodnym tekście (np. „wolałbym toyote corolle”) -> filtry repo.search.
+    Każde słowo (min. 3 znaki) musi pasować do całego tokenu marki/modelu z dokładnością do 1 literówki.
+    """
+    found: Dict[str, str] = {}
+    if _index is None:
+        return found
+    for word in normalize(text).split():
+        if len(word) < MIN_TYPO_LEN:
+            continue
+        for (kind, code), _, _ in _index.complete(word, limit=3):
+            label = CATEGORY_LABELS[kind].get(code) or ""
+            token = normalize(label).split()[-1]
+            if abs(len(token) - len(word)) > 1 or kind in found:
+                continue
+            found[kind] = label
+            if kind == "model":
+                found.setdefault("make", _make_of(label))
+            break
+    # model innej marki niż wskazana wprost – zostaw tylko markę
+    if "model" in found and _make_of(found["model"]) != found.get("make"):
+        found.pop("model")
+    return found
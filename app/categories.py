@@ -0,0 +1,133 @@
+# app/categories.py
+import re
+import unicodedata
+from typing import Dict, Optional, Tuple
+import pandas as pd
+from sqlmodel import Session, select
+from .models import CATEGORY_LABELS, CarModel, City, FuelType, Gearbox, Make, Voivodeship
+
+# kolumna kategoryczna CarListing -> tabela słownikowa
+LOOKUP_MODELS = {
+    "fuel_type": FuelType,
+    "gearbox": Gearbox,
+    "city": City,
+    "voivodeship": Voivodeship,
+    "make": Make,
+    "model": CarModel,
+}
+
+# Synonimy (małe litery) -> etykieta kanoniczna
+SYNONYMS: Dict[str, Dict[str, str]] = {
+    "fuel_type": {
+        "benzyna": "Benzyna", "petrol": "Benzyna", "gasoline": "Benzyna", "pb": "Benzyna",
+        "diesel": "Diesel", "olej napędowy": "Diesel", "on": "Diesel",
+        "hybryda": "Hybryda", "hybrid": "Hybryda",
+        "hybryda plug-in": "Hybryda plug-in", "plug-in hybrid": "Hybryda plug-in",
+        "elektryczny": "Elektryczny", "electric": "Elektryczny", "ev": "Elektryczny",
+        "benzyna+lpg": "Benzyna+LPG", "benzyna + lpg": "Benzyna+LPG", "lpg": "Benzyna+LPG",
+        "benzyna+cng": "Benzyna+CNG", "benzyna + cng": "Benzyna+CNG", "cng": "Benzyna+CNG",
+        "wodór": "Wodór", "hydrogen": "Wodór",
+    },
+    "gearbox": {
+        "manualna": "Manualna", "manual": "Manualna", "manualna skrzynia": "Manualna",
+        "automatyczna": "Automatyczna", "automatic": "Automatyczna", "automat": "Automatyczna",
+    },
+    "make": {
+        "vw": "Volkswagen", "mercedes": "Mercedes-Benz", "mercedes-benz": "Mercedes-Benz",
+        "bmw": "BMW", "kia": "Kia", "mg": "MG", "ds": "DS", "mini": "MINI", "seat": "Seat",
+        "skoda": "Škoda", "škoda": "Škoda", "citroen": "Citroën", "citroën": "Citroën",
+        "alfa romeo": "Alfa Romeo", "land rover": "Land Rover", "aston martin": "Aston Martin",
+        "rolls-royce": "Rolls-Royce", "rolls royce": "Rolls-Royce",
+    },
+}
+
+# Marki dwuwyrazowe (po złożeniu diakrytyków) – reszta marek to pierwszy wyraz tytułu
+MULTIWORD_MAKES = {"alfa romeo", "land rover", "aston martin", "rolls royce"}
+
+# Słowa serii („BMW Seria 3”, „Mercedes-Benz Klasa C”) – model obejmuje też następny wyraz
+SERIES_WORDS = {"seria", "series", "serie", "klasa", "class"}
+
+# kolumna -> etykieta kanoniczna -> kod
+_CODES: Dict[str, Dict[str, int]] = {c: {} for c in LOOKUP_MODELS}
+
+
+def canonicalize(column: str, value) -> Optional[str]:
+    """Etykieta kanoniczna wartości kategorycznej (None dla pustych)."""
+    if value is None or pd.isna(value):
+        return None
+    v = re.sub(r"\s+", " ", str(value)).strip()
+    if not v:
+        return None
+    key = v.lower()
+    if column in SYNONYMS:
+        return SYNONYMS[column].get(key, v[0].upper() + v[1:].lower())
+    if column == "voivodeship":
+        return re.sub(r"^woj(ewództwo|\.)\s*", "", key)
+    if column == "city":
+        return v.title()
+    if column == "model":
+        make, model = split_make_model(v)
+        return model or v
+    return v
+
+
+def split_make_model(title) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Marka i model z tytułu ogłoszenia, np. „toyota corolla 1.6 VVT-i” -> („Toyota”, „Toyota Corolla”).
+    Model zawiera markę, żeby był jednoznaczny; brak drugiego wyrazu -> model None.
+    Po słowie serii brany jest jeszcze jeden wyraz: „BMW Seria 3 320d” -> „BMW Seria 3”.
+    """
+    if title is None or pd.isna(title):
+        return None, None
+    words = str(title).split()
+    if not words or not words[0][0].isalpha():
+        return None, None
+    n = 2 if fold_diacritics(" ".join(words[:2])) in MULTIWORD_MAKES else 1
+    make = canonicalize("make", " ".join(words[:n]))
+    if len(words) <= n:
+        return make, None
+    tokens = words[n:n + 2] if fold_diacritics(words[n]) in SERIES_WORDS else words[n:n + 1]
+    model = " ".join(
+        t.upper() if any(ch.isdigit() for ch in t) or len(t) <= 3 else t.capitalize() for t in tokens
+    )
+    return make, f"{make} {model}"
+
+
+def fold_diacritics(value: str) -> str:
+    """Małe litery bez polskich znaków diakrytycznych („Łódź” -> „lodz”) – do dopasowań tolerancyjnych."""
+    v = value.lower().replace("ł", "l")
+    return "".join(ch for ch in unicodedata.normalize("NFKD", v) if not unicodedata.combining(ch))
+
+
+def load_labels(session: Session) -> None:
+    """Wczytuje tabele słownikowe do pamięci (kody i etykiety)."""
+    for column, model in LOOKUP_MODELS.items():
+        rows = session.exec(select(model)).all()
+        _CODES[column] = {r.name: r.id for r in rows}
+        CATEGORY_LABELS[column].clear()
+        CATEGORY_LABELS[column].update({r.id: r.name for r in rows})
+
+
+def code(column: str, value) -> Optional[int]:
+    """Kod wartości (po kanonizacji i synonimach) albo None, gdy wartość nie występuje w słowniku."""
+    label = canonicalize(column, value)
+    return _CODES[column].get(label) if label is not None else None
+
+
+def encode_series(session: Session, column: str, series: pd.Series) -> pd.Series:
+    """
+    Kanonizuje kolumnę i zamienia ją na kody słownika; brakujące etykiety dopisuje do tabeli.
+    Kanonizacja liczona raz na unikalną wartość, nie na wiersz.
+    """
+    model = LOOKUP_MODELS[column]
+    canon = {v: canonicalize(column, v) for v in series.dropna().unique()}
+    missing = {c for c in canon.values() if c is not None and c not in _CODES[column]}
+    if missing:
+        new = [model(name=name) for name in sorted(missing)]
+        session.add_all(new)
+        session.flush()
+        for r in new:
+            _CODES[column][r.name] = r.id
+            CATEGORY_LABELS[column][r.id] = r.name
+    codes = {v: _CODES[column][c] for v, c in canon.items() if c is not None}
+    return pd.Series([codes.get(v) for v in series], index=series.index, dtype=object)
@@ -1,45 +1,133 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextvars import ContextVar
 from pathlib import Path
+import glob
+import math
+import os
+import time
 import pandas as pd
-from sqlmodel import SQLModel, Session, create_engine
-from .models import CarListing
-from sqlalchemy import text
+from typing import Iterator
+from sqlmodel import SQLModel, Session, create_engine, delete, select
+from .models import CATEGORY_LABELS, CarListing, ImportRun, MarketSegment, PriceHistory
+from .categories import LOOKUP_MODELS, encode_series, load_labels, split_make_model
+from .geo import build_grid, geocode_cities
+from .autocomplete import build_autocomplete
+from sqlalchemy import event, func, insert, inspect, text
 
 DB_URL = "sqlite:///./carlistings.db"
-engine = create_engine(DB_URL, echo=False)
+# check_same_thread=False: eksport strumieniowy czyta kursor z wątków puli FastAPI
+engine = create_engine(DB_URL, echo=False, connect_args={"check_same_thread": False})
+
+# Termin (time.monotonic) zapytań bieżącego żądania; ustawiany przez overload.run_with_deadline
+# w wątku, który wykonuje zapytania. Sprawdzany co PROGRESS_OPS instrukcji maszyny wirtualnej SQLite.
+QUERY_DEADLINE: ContextVar[float | None] = ContextVar("query_deadline", default=None)
+PROGRESS_OPS = 10000
+
+
+def _progress_handler() -> int:
+    # wartość różna od zera przerywa bieżące zapytanie (sqlite3.OperationalError: interrupted)
+    deadline = QUERY_DEADLINE.get()
+    return 1 if deadline is not None and time.monotonic() > deadline else 0
+
+
+@event.listens_for(engine, "connect")
+def _install_progress_handler(dbapi_conn, _record) -> None:
+    # rejestrowane razem z silnikiem, więc obejmuje każde połączenie z puli
+    dbapi_conn.set_progress_handler(_progress_handler, PROGRESS_OPS)
 
 DATA_CSV = Path(__file__).resolve().parents[1] / "data" / "cleaned_aukcje.csv"
+# glob plików importu (np. "data/shards/*.csv"); brak -> DATA_CSV
+DATA_GLOB = os.environ.get("DATA_GLOB") or None
+
+# Wyrażenie SQL odpowiadające normalize_link (indeks ix_carlisting_link_key, wyszukiwanie po linku)
+LINK_KEY_SQL = "lower(rtrim(trim(link), '/'))"
+
+# Wersja danych = id ostatniego importu; składnik ETag-ów stron (httpcache), zmienia się tylko przy imporcie
+_data_version = 0
+
+
+def _drop_legacy_tables():
+    """Tabele pochodne CSV ze starym schematem są odtwarzane – dane i tak pochodzą z importu."""
+    insp = inspect(engine)
+    with engine.begin() as conn:
+        for model in (CarListing, MarketSegment):
+            table = model.__tablename__
+            if not insp.has_table(table):
+                continue
+            if {c["name"] for c in insp.get_columns(table)} != set(model.__table__.columns.keys()):
+                print(f"[db] Odtwarzam tabelę {table} (zmiana schematu)")
+                conn.execute(text(f"DROP TABLE {table}"))
+
 
 def init_db():
+    _drop_legacy_tables()
     SQLModel.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_carlisting_link_key ON carlisting ({LINK_KEY_SQL})"))
+    with Session(engine) as session:
+        load_labels(session)
+        build_grid(session)
+        build_autocomplete(session)
+        _set_data_version(session.exec(select(func.max(ImportRun.id))).one() or 0)
+
+
+def data_version() -> int:
+    return _data_version
+
+
+def _set_data_version(version: int) -> None:
+    global _data_version
+    _data_version = version
 
 def _to_number(series):
     # usuń wszystko poza znakami cyfr, minusem, kropką i przecinkiem, potem zamień , na .
     s = series.astype(str).str.replace(r"[^0-9\-,\.]", "", regex=True).str.replace(",", ".", regex=False)
     return pd.to_numeric(s, errors="coerce")
 
-def seed_from_csv(limit: int | None = None):
-    if not DATA_CSV.exists():
-        raise FileNotFoundError(f"Nie znaleziono pliku: {DATA_CSV}")
-
-    print(f"[seed] Wczytuję CSV: {DATA_CSV}")
-    df = pd.read_csv(DATA_CSV)
-
-    rename_map = {
-        "Title": "title",
-        "Link": "link",
-        "Price": "price",
-        "Mileage": "mileage",
-        "Mileage[KM]": "mileage_km",
-        "Year": "year",
-        "power[HP]": "power_hp",
-        "capacity[cm3]": "capacity_cm3",
-        "Fuel Type": "fuel_type",
-        "Gearbox": "gearbox",
-        "City": "city",
-        "Voivodeship": "voivodeship",
-        "other_info": "other_info",
-    }
-    df = df.rename(columns=rename_map)
+def normalize_link(link) -> str | None:
+    """Znormalizowany link ogłoszenia (klucz dedupu): bez spacji, trailing slash, małe litery."""
+    if link is None or (isinstance(link, float) and math.isnan(link)):
+        return None
+    lk = str(link).strip().rstrip("/").lower()
+    return lk or None
+
+
+def as_float(v):
+    """NaN/None -> None, inaczej float (do porównań między importami)."""
+    if v is None or pd.isna(v):
+        return None
+    return float(v)
+
+
+RENAME_MAP = {
+    "Title": "title",
+    "Link": "link",
+    "Price": "price",
+    "Mileage": "mileage",
+    "Mileage[KM]": "mileage_km",
+    "Year": "year",
+    "power[HP]": "power_hp",
+    "capacity[cm3]": "capacity_cm3",
+    "Fuel Type": "fuel_type",
+    "Gearbox": "gearbox",
+    "City": "city",
+    "Voivodeship": "voivodeship",
+    "other_info": "other_info",
+}
+
+WRITE_BATCH = 10000
+
+
+def _read_shard(path: str) -> tuple[pd.DataFrame, dict]:
+    """
+    Wczytanie i czyszczenie jednego pliku CSV (uruchamiane w procesie roboczym).
+    Zwraca ramkę gotową do kodowania kategorii oraz wpis raportu czasu.
+    """
+    t0 = time.perf_counter()
+    df = pd.read_csv(path)
+    t_read = time.perf_counter() - t0
+
+    df = df.rename(columns=RENAME_MAP)
 
     # Konwersje liczbowe (bezpieczne)
     if "price" in df: df["price"] = _to_number(df["price"])
@@ -49,25 +137,244 @@ def seed_from_csv(limit: int | None = None):
     if "capacity_cm3" in df: df["capacity_cm3"] = _to_number(df["capacity_cm3"])
     if "year" in df: df["year"] = pd.to_numeric(df["year"], errors="coerce").astype("Int64")
 
-    if limit:
-        df = df.head(limit)
+    # marka / model z tytułu (liczone raz na unikalny tytuł)
+    if "title" in df:
+        parsed = {t: split_make_model(t) for t in df["title"].dropna().unique()}
+        df["make"] = df["title"].map(lambda t: parsed.get(t, (None, None))[0])
+        df["model"] = df["title"].map(lambda t: parsed.get(t, (None, None))[1])
 
-    rows = df.to_dict(orient="records")
+    # klucz dedupu liczony od razu w procesie roboczym (jak normalize_link)
+    link = df["link"].astype("string") if "link" in df else pd.Series(pd.NA, index=df.index, dtype="string")
+    df["_link_key"] = link.str.strip().str.rstrip("/").str.lower().replace("", pd.NA)
+    # ten sam link kilka razy w pliku -> zostaje ostatni wiersz
+    dup = df["_link_key"].notna() & df["_link_key"].duplicated(keep="last")
+    df = df[~dup].reset_index(drop=True)
 
-    with Session(engine) as session:
+    report = {
+        "file": Path(path).name,
+        "rows": len(df),
+        "read_s": round(t_read, 3),
+        "clean_s": round(time.perf_counter() - t0 - t_read, 3),
+    }
+    return df, report
+
+
+def _city_voivodeships(session: Session) -> dict[int, str]:
+    """city_id -> najczęstsze województwo w ogłoszeniach z tej miejscowości (do geokodowania)."""
+    best: dict[int, tuple[int, int]] = {}
+    q = (select(CarListing.city_id, CarListing.voivodeship_id, func.count())
+         .where(CarListing.city_id.is_not(None), CarListing.voivodeship_id.is_not(None))
+         .group_by(CarListing.city_id, CarListing.voivodeship_id))
+    for city_id, voiv_id, n in session.exec(q):
+        if city_id not in best or n > best[city_id][1]:
+            best[city_id] = (voiv_id, n)
+    return {c: CATEGORY_LABELS["voivodeship"].get(v) for c, (v, _) in best.items()}
+
+
+def _available_cpus() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # Windows / macOS
+        return os.cpu_count() or 1
+
+
+def _iter_shards(paths: list[str], workers: int) -> Iterator[tuple[int, pd.DataFrame, dict]]:
+    """
+    (nr pliku, ramka, raport) w kolejności ukończenia parsowania – zapis rusza po pierwszym pliku,
+    a procesy robocze (ProcessPoolExecutor) parsują kolejne w tym czasie.
+    Przy jednym procesie parsowanie idzie w bieżącym procesie, plik po pliku.
+    """
+    if workers <= 1:
+        for i, path in enumerate(paths):
+            yield (i, *_read_shard(path))
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(_read_shard, path): i for i, path in enumerate(paths)}
+        try:
+            for fut in as_completed(futures):
+                yield (futures[fut], *fut.result())
+        finally:
+            for fut in futures:  # przerwany import (błąd zapisu) – nie parsuj reszty
+                fut.cancel()
+
+
+def seed_from_csv(
+    limit: int | None = None,
+    pattern: str | None = None,
+    workers: int | None = None,
+) -> tuple[list[CarListing], list[dict]]:
+    """
+    Importuje CSV do tabeli carlisting (z nadpisaniem).
+      - limit: liczba ogłoszeń po scaleniu wszystkich plików (pierwsze w kolejności plików i wierszy);
+        import przycięty nie zapisuje historii cen i zwraca pustą deltę – nie jest pełnym stanem rynku,
+      - pattern: glob plików wejściowych (np. "data/shards/*.csv"); domyślnie DATA_GLOB, potem DATA_CSV,
+      - workers: liczba procesów parsujących (domyślnie min(liczba plików, dostępne rdzenie)).
+    Procesy robocze parsują i czyszczą pliki, a jeden zapisujący (ten proces) koduje kategorie
+    i zapisuje wsadowo każdy plik zaraz po jego sparsowaniu – zapis nakłada się na parsowanie.
+    Ten sam link w kilku plikach: zostaje wiersz z późniejszego pliku (pliki posortowane, nowsze dalej).
+    Zwraca deltę: ogłoszenia nowe lub ze zmienioną ceną/przebiegiem względem poprzedniego importu
+    (porównanie po znormalizowanym linku; ogłoszenia bez linku zawsze traktowane jako nowe).
+    Delta z linkiem trafia też do pricehistory (tylko dopisywanie, wiersz na zmianę).
+    Drugi element wyniku: wiersze (słowniki cena/rocznik/przebieg/paliwo/moc) w starej i nowej
+    wersji ogłoszeń, które zmieniły się rynkowo lub zniknęły – segmenty do przeliczenia w market.
+    """
+    pattern = pattern or DATA_GLOB
+    paths = sorted(glob.glob(pattern)) if pattern else [str(DATA_CSV)]
+    if not paths or not Path(paths[0]).exists():
+        raise FileNotFoundError(f"Nie znaleziono pliku: {pattern or DATA_CSV}")
+    workers = max(1, min(len(paths), workers or _available_cpus()))
+
+    print(f"[seed] Wczytuję CSV ({len(paths)} plik(ów)): {pattern or DATA_CSV}")
+    t0 = time.perf_counter()
+
+    # expire_on_commit=False: obiekty delty zachowują wartości (i id) po commicie
+    with Session(engine, expire_on_commit=False) as session:
+        run = ImportRun(source=pattern or str(DATA_CSV))
+        session.add(run)
+        session.flush()
+        # stan poprzedni: ostatni wpis historii dla linku (pamięta też ogłoszenia, które na chwilę znikły);
+        # bez historii (pierwszy import po aktualizacji) – bieżąca zawartość carlisting
+        last = select(func.max(PriceHistory.id)).group_by(PriceHistory.link_key)
+        previous, gone = {}, set()  # gone: ostatni wpis to zniknięcie z importu
+        for lk, price, mileage, removed in session.exec(
+            select(PriceHistory.link_key, PriceHistory.price, PriceHistory.mileage, PriceHistory.removed)
+            .where(PriceHistory.id.in_(last))
+        ):
+            previous[lk] = (price, mileage)
+            if removed:
+                gone.add(lk)
+        if not previous:
+            previous = {
+                normalize_link(lk): (as_float(price), as_float(mileage))
+                for lk, price, mileage in session.exec(
+                    select(CarListing.link, CarListing.price, CarListing.mileage)
+                )
+            }
+        # stan rynkowy przed importem: ogłoszenia, które znikną lub się zmienią, opuszczają swoje segmenty
+        market_cols = ("price", "year", "mileage", "fuel_type_id", "power_hp")
+        old_market: dict = {}
+        touched: list[dict] = []
+        for row in session.exec(select(CarListing.link, *[getattr(CarListing, c) for c in market_cols])):
+            values = dict(zip(market_cols, (as_float(v) for v in row[1:])))
+            lk = normalize_link(row[0])
+            if lk is None:
+                touched.append(values)
+            else:
+                old_market[lk] = values
         session.exec(text("DELETE FROM carlisting"))
+        load_labels(session)
+
+        # zapis wsadowy (executemany + RETURNING id) zamiast obiektów ORM wiersz po wierszu
+        stmt = insert(CarListing).returning(CarListing.id, sort_by_parameter_order=True)
+        # link_key -> (nr pliku, nr wiersza, id, wiersz); ogłoszenia bez linku osobno, te same krotki
+        written: dict[str, tuple[int, int, int, dict]] = {}
+        unlinked: list[tuple[int, int, int, dict]] = []
+        report = []
+        t_write = 0.0
+        shards = _iter_shards(paths, workers)
+        try:
+            for shard, df, shard_report in shards:
+                t1 = time.perf_counter()
+                report.append(shard_report)
+                # kategorie -> kody słowników (kanonizacja + synonimy, nowe etykiety dopisywane)
+                for column in LOOKUP_MODELS:
+                    if column in df:
+                        df[f"{column}_id"] = encode_series(session, column, df.pop(column))
+                link_keys = df.pop("_link_key").astype(object).where(lambda s: s.notna(), None).tolist()
+                columns = [c for c in CarListing.__table__.columns.keys() if c != "id" and c in df]
+                df = df[columns].astype(object)
+                rows = df.where(df.notna(), None).to_dict(orient="records")
+
+                keep, stale = [], []
+                for pos, (r, lk) in enumerate(zip(rows, link_keys)):
+                    if lk is not None and lk in written:
+                        if written[lk][0] > shard:
+                            continue  # ten link jest już zapisany z późniejszego pliku
+                        stale.append(written[lk][2])
+                    keep.append((pos, r, lk))
+                for start in range(0, len(stale), WRITE_BATCH):
+                    session.exec(delete(CarListing).where(CarListing.id.in_(stale[start:start + WRITE_BATCH])))
+                for start in range(0, len(keep), WRITE_BATCH):
+                    part = keep[start:start + WRITE_BATCH]
+                    ids = session.execute(stmt, [r for _, r, _ in part]).scalars().all()
+                    for (pos, r, lk), car_id in zip(part, ids):
+                        if lk is None:
+                            unlinked.append((shard, pos, car_id, r))
+                        else:
+                            written[lk] = (shard, pos, car_id, r)
+                    session.commit()
+                t_write += time.perf_counter() - t1
+                print(f"[seed] Zaimportowano: {len(written) + len(unlinked)} (plik {shard_report['file']})")
+        finally:
+            shards.close()
+
+        # limit dopiero po scaleniu (późniejszy plik wygrywa), w kolejności plików – wynik nie zależy
+        # od kolejności parsowania; nadmiarowe wiersze są usuwane
+        final = sorted(
+            [(shard, pos, car_id, r, lk) for lk, (shard, pos, car_id, r) in written.items()]
+            + [(shard, pos, car_id, r, None) for shard, pos, car_id, r in unlinked],
+            key=lambda f: f[:2],
+        )
+        truncated = bool(limit) and len(final) > limit
+        if truncated:
+            extra = [f[2] for f in final[limit:]]
+            final = final[:limit]
+            for start in range(0, len(extra), WRITE_BATCH):
+                session.exec(delete(CarListing).where(CarListing.id.in_(extra[start:start + WRITE_BATCH])))
+            session.commit()
+            print(f"[seed] Limit {limit}: pominięto {len(extra)} ogłoszeń (bez historii cen i delty)")
+        t_total = time.perf_counter() - t0
+
+        # nowe miasta -> współrzędne z lokalnego gazetera, potem przebudowa siatki
+        geocode_cities(session, _city_voivodeships(session))
         session.commit()
+        build_grid(session)
 
-        added = 0
-        for r in rows:
-            session.add(CarListing(**r))
-            added += 1
-            if added % 10000 == 0:
-                session.commit()
-                print(f"[seed] Zaimportowano: {added}")
+        delta = []
+        history = {}  # link_key -> wiersz historii
+        for _, _, car_id, r, lk in final:
+            market = {c: as_float(r.get(c)) for c in market_cols}
+            old = old_market.pop(lk, None) if lk is not None else None
+            if old != market:
+                touched.append(market)
+                if old is not None:
+                    touched.append(old)
+            if truncated:
+                continue  # porównanie z poprzednim importem tylko dla pełnego importu
+            current = (as_float(r.get("price")), as_float(r.get("mileage")))
+            # powrót po zniknięciu zawsze dostaje wpis (nowe ogłoszenie; obniżka względem ostatniej ceny)
+            if lk is None or previous.get(lk) != current or lk in gone:
+                delta.append(CarListing(id=car_id, **r))
+                if lk is not None:
+                    prev = previous.get(lk)
+                    history[lk] = {
+                        "link_key": lk, "import_id": run.id, "price": current[0], "mileage": current[1],
+                        "prev_price": prev[0] if prev else None, "removed": False,
+                    }
+        added = len(final)
+        touched.extend(old_market.values())  # ogłoszenia, których nie ma w nowym imporcie
+        if not truncated:
+            # zniknięcie z importu to też zmiana: koniec czasu na rynku w listing_history
+            for lk, (price, mileage) in previous.items():
+                if lk is not None and lk not in written and lk not in gone:
+                    history[lk] = {
+                        "link_key": lk, "import_id": run.id, "price": price, "mileage": mileage,
+                        "prev_price": price, "removed": True,
+                    }
 
+        if history:
+            session.exec(insert(PriceHistory), params=list(history.values()))
+        run.rows, run.changed = added, len(delta)
+        session.add(run)
         session.commit()
-        print(f"[seed] GOTOWE. Zaimportowano łącznie: {added} rekordów.")
+        build_autocomplete(session)
+        _set_data_version(run.id)
+
+        for r in sorted(report, key=lambda r: r["file"]):
+            print(f"[seed]   {r['file']}: {r['rows']} wierszy, odczyt {r['read_s']}s, czyszczenie {r['clean_s']}s")
+        print(f"[seed] Parsowanie ({workers} proc.) i zapis: {t_total:.2f}s łącznie, w tym zapis: {t_write:.2f}s")
+        print(f"[seed] GOTOWE. Zaimportowano łącznie: {added} rekordów (nowe/zmienione: {len(delta)}).")
+        return delta, touched
 
 def get_session():
     return Session(engine)
@@ -0,0 +1,140 @@
+# app/geo.py
+import csv
+import math
+import os
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from sqlmodel import Session, select
+from .models import City
+from .categories import canonicalize, code, fold_diacritics
+
+# lokalny gazeter (name,voivodeship,lat,lon): wszystkie miasta Polski; listę z wsiami (np. z TERYT/GeoNames)
+# można podać przez GAZETTEER_CSV
+GAZETTEER_CSV = Path(os.environ.get("GAZETTEER_CSV") or Path(__file__).resolve().parent / "data" / "gazetteer_pl.csv")
+
+EARTH_RADIUS_KM = 6371.0
+# Oczko siatki ~28 km × ~27 km (na szerokości Polski)
+CELL_LAT = 0.25
+CELL_LON = 0.4
+
+Cell = Tuple[int, int]
+
+# nazwa bez diakrytyków -> [(województwo bez diakrytyków, lat, lon)]; kolejność z pliku (większe najpierw)
+_GAZETTEER: Dict[str, List[Tuple[str, float, float]]] = {}
+# siatka: oczko -> [(city_id, lat, lon)]; tylko miasta z ogłoszeniami (tabela city)
+_GRID: Dict[Cell, List[Tuple[int, float, float]]] = defaultdict(list)
+_CITY_POS: Dict[int, Tuple[float, float]] = {}
+
+
+def _gazetteer() -> Dict[str, List[Tuple[str, float, float]]]:
+    if not _GAZETTEER:
+        with open(GAZETTEER_CSV, encoding="utf-8", newline="") as f:
+            for r in csv.DictReader(f):
+                _GAZETTEER.setdefault(fold_diacritics(r["name"]), []).append(
+                    (fold_diacritics(r.get("voivodeship") or ""), float(r["lat"]), float(r["lon"]))
+                )
+    return _GAZETTEER
+
+
+def _gazetteer_lookup(name: str, voivodeship: Optional[str] = None) -> Optional[Tuple[float, float]]:
+    """
+    Współrzędne z gazetera. Miejscowości o tej samej nazwie rozróżnia województwo;
+    bez województwa (lub bez zgodnego wpisu) – pierwszy, największy wpis.
+    """
+    entries = _gazetteer().get(fold_diacritics(name))
+    if not entries:
+        return None
+    voiv = canonicalize("voivodeship", voivodeship)
+    if voiv:
+        for v, lat, lon in entries:
+            if v == fold_diacritics(voiv):
+                return lat, lon
+    return entries[0][1], entries[0][2]
+
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp, dl = p2 - p1, math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def _cell(lat: float, lon: float) -> Cell:
+    return (math.floor(lat / CELL_LAT), math.floor(lon / CELL_LON))
+
+
+def geocode_cities(session: Session, voivodeships: Optional[Dict[int, str]] = None) -> int:
+    """
+    Uzupełnia lat/lon miast bez współrzędnych na podstawie gazetera. Zwraca liczbę trafień.
+    voivodeships: city_id -> województwo z ogłoszeń (rozróżnia miejscowości o tej samej nazwie).
+    """
+    voivodeships = voivodeships or {}
+    found, missing = 0, []
+    for city in session.exec(select(City).where(City.lat.is_(None))):
+        pos = _gazetteer_lookup(city.name, voivodeships.get(city.id))
+        if pos is not None:
+            city.lat, city.lon = pos
+            session.add(city)
+            found += 1
+        else:
+            missing.append(city.name)
+    if missing:
+        # takie miejscowości trafiają tylko do wyszukiwań po własnej nazwie (bez promienia)
+        print(f"[geo] Brak w gazeterze: {len(missing)} miejscowości, np. {', '.join(sorted(missing)[:5])}")
+    return found
+
+
+def build_grid(session: Session) -> None:
+    """Buduje siatkę przestrzenną miast z tabeli city (wywoływane po imporcie)."""
+    _GRID.clear()
+    _CITY_POS.clear()
+    for city in session.exec(select(City).where(City.lat.is_not(None))):
+        _GRID[_cell(city.lat, city.lon)].append((city.id, city.lat, city.lon))
+        _CITY_POS[city.id] = (city.lat, city.lon)
+
+
+def locate(name: Optional[str], voivodeship: Optional[str] = None) -> Optional[Tuple[float, float]]:
+    """Współrzędne miejscowości: najpierw tabela city, potem gazeter (miasto nie musi mieć ogłoszeń)."""
+    if not name:
+        return None
+    label = canonicalize("city", name)
+    if label and voivodeship:
+        pos = _gazetteer_lookup(label, voivodeship)
+        if pos is not None:
+            return pos
+    city_id = code("city", name)
+    if city_id in _CITY_POS:
+        return _CITY_POS[city_id]
+    return _gazetteer_lookup(label) if label else None
+
+
+def cities_within(
+    name: Optional[str], radius_km: float, voivodeship: Optional[str] = None,
+) -> Optional[Dict[int, float]]:
+    """
+    Miasta (city_id -> odległość w km) w promieniu radius_km od miejscowości `name`
+    (voivodeship rozróżnia miejscowości o tej samej nazwie).
+    Najpierw zawężenie do oczek siatki pokrywających okrąg, dokładny dystans tylko dla nich.
+    Sama miejscowość jest zawsze w wyniku (odległość 0), także bez współrzędnych w gazeterze.
+    None, gdy miejscowości nie ma ani w ogłoszeniach, ani w gazeterze.
+    """
+    own = code("city", name) if name else None
+    origin = locate(name, voivodeship)
+    if origin is None:
+        return {own: 0.0} if own is not None else None
+    lat0, lon0 = origin
+    radius_km = max(0.0, radius_km)
+    dlat = radius_km / 111.0
+    dlon = radius_km / (111.0 * max(0.1, math.cos(math.radians(lat0))))
+    (r0, c0), (r1, c1) = _cell(lat0 - dlat, lon0 - dlon), _cell(lat0 + dlat, lon0 + dlon)
+    out = {}
+    for r in range(r0, r1 + 1):
+        for c in range(c0, c1 + 1):
+            for city_id, lat, lon in _GRID.get((r, c), ()):
+                d = haversine_km(lat0, lon0, lat, lon)
+                if d <= radius_km:
+                    out[city_id] = d
+    if own is not None:
+        out[own] = 0.0
+    return out
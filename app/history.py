@@ -0,0 +1,81 @@
+# app/history.py
+from typing import Any, Dict, List
+from sqlalchemy import func, literal_column
+from sqlmodel import Session, select
+from .models import CarListing, ImportRun, PriceHistory
+from .db import LINK_KEY_SQL
+
+# Zapis historii odbywa się w db.seed_from_csv (razem z importem); tu są zapytania.
+
+
+def price_drops(session: Session, last_imports: int = 1, limit: int = 100) -> List[Dict[str, Any]]:
+    """
+    Obniżki cen z ostatnich `last_imports` importów, największe procentowo najpierw.
+    Zapytanie po indeksie import_id; prev_price jest zapisany w wierszu historii.
+    """
+    last_id = session.exec(select(func.max(ImportRun.id))).one()
+    if last_id is None:
+        return []
+    drop_pct = (PriceHistory.prev_price - PriceHistory.price) / PriceHistory.prev_price
+    q = (select(PriceHistory, ImportRun.started_at)
+         .join(ImportRun, ImportRun.id == PriceHistory.import_id)
+         .where(PriceHistory.import_id > last_id - last_imports,
+                PriceHistory.prev_price.is_not(None),
+                PriceHistory.price < PriceHistory.prev_price)
+         .order_by(drop_pct.desc())
+         .limit(limit))
+    drops = session.exec(q).all()
+
+    # bieżące dane ogłoszeń – po indeksie wyrażeniowym na znormalizowanym linku
+    link_key = literal_column(LINK_KEY_SQL)
+    keys = [h.link_key for h, _ in drops]
+    listings = {}
+    if keys:
+        for car, key in session.exec(select(CarListing, link_key).where(link_key.in_(keys))):
+            listings.setdefault(key, car)
+
+    out = []
+    for h, at in drops:
+        car = listings.get(h.link_key)
+        out.append({
+            "link": car.link if car else None,  # ogłoszenia już nie ma – tylko link_key
+            "title": car.title if car else None,
+            "price": h.price,
+            "prev_price": h.prev_price,
+            "drop": h.prev_price - h.price,
+            "drop_pct": round(100 * (h.prev_price - h.price) / h.prev_price, 1),
+            "import_id": h.import_id,
+            "changed_at": at,
+        })
+    return out
+
+
+def listing_history(session: Session, link_key: str) -> Dict[str, Any]:
+    """
+    Pełna historia ceny/przebiegu ogłoszenia oraz czas na rynku: od pierwszego wpisu do ostatniego
+    importu, w którym ogłoszenie było (gdy zniknęło – import przed wpisem removed).
+    """
+    q = (select(PriceHistory, ImportRun.started_at)
+         .join(ImportRun, ImportRun.id == PriceHistory.import_id)
+         .where(PriceHistory.link_key == link_key)
+         .order_by(PriceHistory.id.asc()))
+    rows = session.exec(q).all()
+    if not rows:
+        return {"link_key": link_key, "history": []}
+    last = rows[-1][0]
+    seen = select(ImportRun.started_at).order_by(ImportRun.id.desc()).limit(1)
+    if last.removed:
+        seen = seen.where(ImportRun.id < last.import_id)
+    last_seen = session.exec(seen).one()
+    first_seen = rows[0][1]
+    return {
+        "link_key": link_key,
+        "first_seen": first_seen,
+        "last_seen": last_seen,
+        "active": not last.removed,
+        "days_on_market": (last_seen - first_seen).days,
+        "history": [
+            {"import_id": h.import_id, "at": at, "price": h.price, "mileage": h.mileage}
+            for h, at in rows if not h.removed
+        ],
+    }
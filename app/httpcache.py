@@ -0,0 +1,262 @@
+# app/httpcache.py
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import stat
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+import anyio
+from starlette.datastructures import Headers
+from starlette.requests import Request
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+from starlette.types import Scope
+
+from .db import data_version
+
+try:  # brotli jest opcjonalny – bez niego serwujemy gzip
+    import brotli
+except ImportError:
+    brotli = None
+
+TEMPLATES_DIR = Path(__file__).resolve().parent / "templates"
+
+PAGE_CACHE_ENTRIES = 256      # wyrenderowane strony (LRU – zostają te najczęściej odwiedzane)
+MIN_COMPRESS_SIZE = 1024      # mniejsze odpowiedzi nie opłaca się kompresować
+GZIP_LEVEL = 6
+BROTLI_PAGE_QUALITY = 9       # strony kompresowane raz na wersję danych
+BROTLI_STATIC_QUALITY = 11    # pliki statyczne kompresowane raz przy starcie
+
+# HTML zależy od danych, które zmieniają się tylko przy imporcie: przeglądarka zawsze pyta (tanie 304)
+PAGE_CACHE_CONTROL = "no-cache"
+STATIC_CACHE_CONTROL = "public, max-age=86400"
+COMPRESSIBLE_SUFFIXES = {".css", ".js", ".svg", ".html", ".json", ".txt", ".map"}
+
+_DEPENDS_RE = re.compile(r"""{%-?\s*(?:extends|include|import|from)\s+["']([^"']+)["']""")
+
+# nazwa szablonu -> (mtime_ns, skrót treści razem z szablonami, od których zależy)
+_TEMPLATE_DIGESTS: Dict[str, Tuple[int, bytes]] = {}
+
+
+class _Page:
+    __slots__ = ("body", "media_type", "encoded")
+
+    def __init__(self, body: bytes, media_type: str):
+        self.body = body
+        self.media_type = media_type
+        self.encoded: Dict[str, bytes] = {}  # kodowanie -> skompresowane ciało (liczone leniwie)
+
+
+_PAGES: "OrderedDict[str, _Page]" = OrderedDict()
+_pages_version: Optional[int] = None
+_pages_lock = threading.Lock()  # strony renderowane są też w wątkach puli (overload.run_with_deadline)
+
+
+def _template_digest(name: str) -> bytes:
+    """Skrót szablonu i szablonów, które rozszerza/dołącza; przeliczany po zmianie pliku."""
+    path = TEMPLATES_DIR / name
+    mtime = path.stat().st_mtime_ns
+    cached = _TEMPLATE_DIGESTS.get(name)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    source = path.read_bytes()
+    h = hashlib.sha1(source)
+    for dep in _DEPENDS_RE.findall(source.decode("utf-8")):
+        if dep != name:
+            h.update(_template_digest(dep))
+    _TEMPLATE_DIGESTS[name] = (mtime, h.digest())
+    return h.digest()
+
+
+def page_etag(template: str, params: Dict) -> str:
+    """Słaby ETag strony: szablon (z zależnościami) + parametry + wersja danych z ostatniego importu."""
+    h = hashlib.sha1(_template_digest(template))
+    h.update(str(data_version()).encode())
+    h.update(repr(sorted((k, v) for k, v in params.items() if v is not None)).encode())
+    return f'W/"{h.hexdigest()[:24]}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Porównanie słabe (RFC 9110): W/ nie ma znaczenia, "*" pasuje do wszystkiego."""
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return "*" in tags or any(t.removeprefix("W/") == etag.removeprefix("W/") for t in tags)
+
+
+def choose_encoding(accept_encoding: Optional[str], available: Iterable[str]) -> Optional[str]:
+    """Najlepsze kodowanie z Accept-Encoding (br przed gzip przy równym q); None = bez kompresji."""
+    accepted: Dict[str, float] = {}
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.strip().partition(";")
+        if not name:
+            continue
+        q = 1.0
+        m = re.search(r"q=([0-9.]+)", params)
+        if m:
+            try:
+                q = float(m.group(1))
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+    best, best_q = None, 0.0
+    for enc in available:
+        q = accepted.get(enc, accepted.get("*", 0.0))
+        if q > best_q:
+            best, best_q = enc, q
+    return best
+
+
+def _encodings() -> Tuple[str, ...]:
+    return ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def compress(body: bytes, encoding: str, static: bool = False) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_STATIC_QUALITY if static else BROTLI_PAGE_QUALITY)
+    # mtime=0: ten sam wynik dla tej samej treści
+    return gzip.compress(body, compresslevel=9 if static else GZIP_LEVEL, mtime=0)
+
+
+def _encoded_response(request: Request, page: _Page, headers: Dict[str, str]) -> Response:
+    headers = dict(headers, Vary="Accept-Encoding")
+    body = page.body
+    encoding = None
+    if len(body) >= MIN_COMPRESS_SIZE:
+        encoding = choose_encoding(request.headers.get("accept-encoding"), _encodings())
+    if encoding is not None:
+        if encoding not in page.encoded:
+            page.encoded[encoding] = compress(body, encoding)
+        body = page.encoded[encoding]
+        headers["Content-Encoding"] = encoding
+    return Response(body, media_type=page.media_type, headers=headers)
+
+
+def _page_headers(request: Request, etag: str) -> Dict[str, str]:
+    if request.method == "GET":
+        return {"ETag": etag, "Cache-Control": PAGE_CACHE_CONTROL}
+    # odpowiedzi na POST nie są rewalidowane przez przeglądarki – cache tylko po stronie serwera
+    return {"Cache-Control": "no-store"}
+
+
+def _get_page(etag: str) -> Optional[_Page]:
+    global _pages_version
+    with _pages_lock:
+        version = data_version()
+        if _pages_version != version:
+            _PAGES.clear()  # nowy import – stare strony i tak mają nieaktualne klucze
+            _pages_version = version
+        page = _PAGES.get(etag)
+        if page is not None:
+            _PAGES.move_to_end(etag)
+        return page
+
+
+def _put_page(etag: str, page: _Page) -> None:
+    with _pages_lock:
+        _PAGES[etag] = page
+        if len(_PAGES) > PAGE_CACHE_ENTRIES:
+            _PAGES.popitem(last=False)
+
+
+def lookup_page(request: Request, template: str, params: Dict) -> Optional[Response]:
+    """Odpowiedź bez renderowania (304 albo strona z cache) lub None, gdy trzeba renderować."""
+    etag = page_etag(template, params)
+    headers = _page_headers(request, etag)
+    if request.method == "GET" and etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    page = _get_page(etag)
+    return _encoded_response(request, page, headers) if page is not None else None
+
+
+def cached_page(request: Request, template: str, params: Dict, render: Callable[[], Response]) -> Response:
+    """
+    Strona HTML z pamięci podręcznej:
+      - GET z pasującym If-None-Match -> 304 bez renderowania i bez zapytań do bazy,
+      - wyrenderowane ciało trzymane w LRU pod ETag-iem (klucz zawiera wersję danych),
+      - odpowiedź kompresowana br/gzip wg Accept-Encoding (wynik kompresji też w cache).
+    render() wykonuje zapytania i zwraca TemplateResponse – wołane tylko przy braku w cache.
+    """
+    cached = lookup_page(request, template, params)
+    if cached is not None:
+        return cached
+    etag = page_etag(template, params)
+    response = render()
+    if response.status_code != 200:
+        return response
+    page = _Page(bytes(response.body), response.media_type or "text/html")
+    _put_page(etag, page)
+    return _encoded_response(request, page, _page_headers(request, etag))
+
+
+def precompress_static(directory: str) -> int:
+    """
+    Zapisuje obok plików statycznych wersje .gz (i .br, jeśli jest brotli) – raz, przy starcie.
+    Pomija pliki, których skompresowana wersja jest nowsza od źródła. Zwraca liczbę zapisanych plików.
+    Katalog tylko do odczytu (lub inny błąd zapisu) nie blokuje startu – pliki idą wtedy bez kompresji
+    (PrecompressedStaticFiles nie serwuje wersji starszych od źródła).
+    """
+    written = 0
+    try:
+        for root, _, files in os.walk(directory):
+            for fname in files:
+                src = Path(root) / fname
+                if src.suffix not in COMPRESSIBLE_SUFFIXES:
+                    continue
+                data = None
+                for encoding, ext in (("gzip", ".gz"), ("br", ".br")):
+                    if encoding not in _encodings():
+                        continue
+                    dst = src.with_name(src.name + ext)
+                    if dst.exists() and dst.stat().st_mtime_ns >= src.stat().st_mtime_ns:
+                        continue
+                    data = src.read_bytes() if data is None else data
+                    # zapis przez plik tymczasowy – równoległe żądanie nie dostanie uciętego pliku
+                    tmp = dst.with_name(dst.name + ".tmp")
+                    tmp.write_bytes(compress(data, encoding, static=True))
+                    os.replace(tmp, dst)
+                    written += 1
+    except OSError as e:
+        print(f"[http] Nie można zapisać skompresowanych plików statycznych ({e}) – serwuję bez kompresji")
+    if written:
+        print(f"[http] Skompresowano pliki statyczne: {written}")
+    return written
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """
+    StaticFiles serwujące gotowe wersje .br/.gz (z precompress_static), gdy klient je akceptuje.
+    ETag/Last-Modified i 304 jak w StaticFiles, do tego Cache-Control i Vary.
+    """
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        request_headers = Headers(scope=scope)
+        encoding = choose_encoding(request_headers.get("accept-encoding"), _encodings())
+        if encoding is not None:
+            ext = ".br" if encoding == "br" else ".gz"
+            full_path, stat_result = await anyio.to_thread.run_sync(self.lookup_path, path + ext)
+            _, source_stat = await anyio.to_thread.run_sync(self.lookup_path, path)
+            # wersja skompresowana tylko, gdy jest aktualna (zapis przy starcie mógł się nie udać)
+            if (stat_result is not None and stat.S_ISREG(stat_result.st_mode)
+                    and source_stat is not None and stat_result.st_mtime_ns >= source_stat.st_mtime_ns):
+                media_type = mimetypes.guess_type(path)[0] or "text/plain"
+                response = FileResponse(full_path, stat_result=stat_result, media_type=media_type)
+                response.headers["Content-Encoding"] = encoding
+                self._cache_headers(response)
+                if self.is_not_modified(response.headers, request_headers):
+                    return NotModifiedResponse(response.headers)
+                return response
+        response = await super().get_response(path, scope)
+        self._cache_headers(response)
+        return response
+
+    @staticmethod
+    def _cache_headers(response: Response) -> None:
+        if response.status_code in (200, 304):
+            response.headers["Cache-Control"] = STATIC_CACHE_CONTROL
+            response.headers["Vary"] = "Accept-Encoding"
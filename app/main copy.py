@@ -6,6 +6,7 @@ from typing import Optional, Iterable, List, Dict, Any
 
 from .db import init_db, seed_from_csv
 from .repo import get_distinct_values, search
+from .market import refresh_after_import, below_market_score
 
 app = FastAPI(title="Car Chooser – wagi silne + deduplikacja + dynamiczna normalizacja")
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
@@ -17,12 +18,14 @@ CURRENT_YEAR = 2025
 INTENSITY = 4
 ALPHA = 1 + 0.5 * INTENSITY  # 3.0  -> wzmacnia wagi
 TAU   = 1 + 0.5 * INTENSITY  # 3.0  -> wyostrza dopasowanie
+MARKET_WEIGHT = 0.15         # stała waga składowej „poniżej rynku”
 
 
 @app.on_event("startup")
 async def startup_event():
     init_db()
-    seed_from_csv(limit=None)  # zmień na None dla pełnego importu
+    _, touched = seed_from_csv(limit=None)  # zmień na None dla pełnego importu
+    refresh_after_import(touched)
 
 
 def _to_float(x: Optional[str]) -> Optional[float]:
@@ -164,6 +167,9 @@ def _score_car(car, weights_strong: Dict[str, float], scalers: Dict[str, Dict[st
     s_year    = s_year    ** TAU
     s_power   = s_power   ** TAU
 
+    # cena na tle segmentu rynkowego (nie tylko względem bieżących kandydatów)
+    s_market  = below_market_score(car)
+
     # drobne premie za kompletność oferty
     bonus = 0.0
     if car.link:               bonus += 0.01
@@ -174,6 +180,7 @@ def _score_car(car, weights_strong: Dict[str, float], scalers: Dict[str, Dict[st
         weights_strong["mileage"] * s_mileage +
         weights_strong["year"]    * s_year +
         weights_strong["power"]   * s_power +
+        MARKET_WEIGHT * s_market +
         bonus
     )
     return float(score)
@@ -1,24 +1,48 @@
 from fastapi import FastAPI, Request, Form
-from fastapi.responses import HTMLResponse, JSONResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from fastapi.templating import Jinja2Templates
 from typing import Optional, List, Dict, Any
+import csv
+import io
 import json
 
-from .db import init_db, seed_from_csv
-from .repo import get_distinct_values, search
+from .db import DATA_GLOB, get_session, init_db, seed_from_csv, normalize_link
+from .models import CarListing, SavedSearch
+from .categories import LOOKUP_MODELS
+from .repo import SEARCH_FILTERS, get_distinct_values, search, search_batch, stream_search
+from .geo import cities_within
+from .autocomplete import complete, resolve_make_model
+from .history import listing_history, price_drops
+from .market import refresh_after_import, below_market_score
+from .alerts import create_saved_search, delete_saved_search, list_saved_searches, get_notifications, match_new_listings
+from .httpcache import PrecompressedStaticFiles, cached_page, lookup_page, precompress_static
+from .overload import (
+    DEGRADED_BUDGET_S, DEGRADED_LIMIT, GATES, DeadlineExceeded, check_deadline, overload_stats, run_with_deadline,
+)
 
 app = FastAPI(title="Asystent Samochodowy – Znajdź idealne auto")
-app.mount("/static", StaticFiles(directory="app/static"), name="static")
+app.mount("/static", PrecompressedStaticFiles(directory="app/static"), name="static")
 templates = Jinja2Templates(directory="app/templates")
 
 CURRENT_YEAR = 2025
 
+# Limity dla /advanced_results/batch
+BATCH_MAX_SPECS = 200
+BATCH_MAX_LIMIT = 200
+
+# Komendy czatu uruchamiające wyszukiwanie
+SEARCH_COMMANDS = {"szukaj", "wyszukaj", "pokaż wyniki", "pokaz wyniki"}
+
 
 @app.on_event("startup")
 async def startup_event():
     init_db()
-    seed_from_csv(limit=100000)
+    precompress_static("app/static")
+    # import z wielu plików (DATA_GLOB) zawsze pełny – limit służy tylko do szybkiego startu na DATA_CSV
+    delta, touched = seed_from_csv(limit=None if DATA_GLOB else 100000)
+    refresh_after_import(touched)
+    match_new_listings(delta)
 
 
 def _to_float(x: Optional[str]) -> Optional[float]:
@@ -51,7 +75,7 @@ def _dedup_listings(candidates):
     seen_links = set()
     out = []
     for c in candidates:
-        lk = (str(c.link).strip().rstrip("/").lower()) if getattr(c, "link", None) else None
+        lk = normalize_link(getattr(c, "link", None))
         if lk:
             if lk in seen_links:
                 continue
@@ -115,6 +139,13 @@ class CarAssistant:
 
         return {"message": "Przepraszam, coś poszło nie tak. Zacznijmy od nowa.", "restart": True}
 
+    def wants_search(self, session_id: str, response: str, option_selected: Optional[str] = None) -> bool:
+        """Czy ta wiadomość uruchomi wyszukiwanie (pełny potok) – do kontroli dopuszczenia w /chat."""
+        state = self.conversation_states.get(session_id)
+        user_input = (option_selected or response or "").strip().lower()
+        return (state is not None and state["step"] in ("final_preferences", "ready_to_search")
+                and user_input in SEARCH_COMMANDS)
+
     # ----- Kroki rozmowy -----
 
     def _process_usage(self, session_id: str, response: str) -> Dict[str, Any]:
@@ -228,12 +259,18 @@ class CarAssistant:
 
     def _process_final(self, session_id: str, response: str) -> Dict[str, Any]:
         state = self.conversation_states[session_id]
-        if response.strip().lower() in {"szukaj", "wyszukaj", "pokaż wyniki", "pokaz wyniki"}:
+        if response.strip().lower() in SEARCH_COMMANDS:
             return self._generate_search_results(session_id)
 
         state["preferences"]["additional"] = response
+        mm = resolve_make_model(response)
+        if mm:
+            state["context"]["make_model"] = mm
         return {
-            "message": "Zapisane. Jeśli chcesz zobaczyć oferty, napisz „szukaj”.",
+            "message": (
+                f"Zapisane – uwzględnię: {mm.get('model') or mm.get('make')}. "
+                if mm else "Zapisane. "
+            ) + "Jeśli chcesz zobaczyć oferty, napisz „szukaj”.",
             "show_search": True,
             "step": "ready_to_search"
         }
@@ -321,6 +358,8 @@ class CarAssistant:
             if context.get("context") == "highway" and getattr(car, "power_hp", None):
                 if car.power_hp >= 120:
                     score += 0.2
+            # cena na tle rynku (segment rocznik × przebieg × paliwo × moc)
+            score += (below_market_score(car) - 0.5) * 0.4
             if getattr(car, "link", None):
                 score += 0.05
             if all([getattr(car, "price", None), getattr(car, "year", None), getattr(car, "mileage", None), getattr(car, "power_hp", None)]):
@@ -331,10 +370,12 @@ class CarAssistant:
                                    -(x[1].year if x[1].year is not None else 0)))
         return [c for _, c in scored]
 
-    def _generate_search_results(self, session_id: str) -> Dict[str, Any]:
+    def _generate_search_results(self, session_id: str, limit: int = 200) -> Dict[str, Any]:
         state = self.conversation_states[session_id]
         params = self._preferences_to_search_params(state["preferences"])
-        candidates = search(**params)
+        params.update(state["context"].get("make_model", {}))
+        candidates = search(**params, limit=limit)
+        check_deadline()
         candidates = _dedup_listings(candidates)
         ranked = self._score_by_preferences(candidates, state)
         return {
@@ -354,7 +395,18 @@ car_assistant = CarAssistant()
 @app.get("/", response_class=HTMLResponse)
 async def index(request: Request):
     """Strona główna z interfejsem asystenta"""
-    return templates.TemplateResponse("assistant_index.html", {"request": request})
+    return cached_page(
+        request, "assistant_index.html", {},
+        lambda: templates.TemplateResponse("assistant_index.html", {"request": request}),
+    )
+
+
+def _chat_unavailable(gate, text: str) -> JSONResponse:
+    """503 dla czatu w kształcie zwykłej odpowiedzi asystenta (frontend wyświetla `message`)."""
+    return JSONResponse(
+        {"message": text, "error": text, "show_search": True, "retry_after": gate.retry_after_s},
+        status_code=503, headers=gate.retry_headers(),
+    )
 
 
 @app.post("/chat", response_class=JSONResponse)
@@ -367,29 +419,56 @@ async def chat(request: Request):
     action = body.get("action", "chat")
 
     if action == "start":
-        resp = car_assistant.start_conversation(session_id)
-    else:
-        resp = car_assistant.process_response(session_id, message, option_selected)
-
-    return resp
+        return car_assistant.start_conversation(session_id)
+    if not car_assistant.wants_search(session_id, message, option_selected):
+        return car_assistant.process_response(session_id, message, option_selected)
+
+    # wyszukiwanie: limit równoległych żądań, budżet czasu, a po jego przekroczeniu mniejszy top-N
+    gate = GATES["chat_search"]
+    if not gate.try_enter():
+        return _chat_unavailable(gate, "Duży ruch – spróbuj ponownie za chwilę.")
+    try:
+        try:
+            return await run_in_threadpool(
+                run_with_deadline, gate.budget_s, car_assistant.process_response, session_id, message, option_selected,
+            )
+        except DeadlineExceeded:
+            gate.count("deadline_missed")
+        try:
+            resp = await run_in_threadpool(
+                run_with_deadline, DEGRADED_BUDGET_S,
+                car_assistant._generate_search_results, session_id, DEGRADED_LIMIT,
+            )
+        except DeadlineExceeded:
+            gate.count("deadline_missed")
+            return _chat_unavailable(gate, "Wyszukiwanie trwa zbyt długo – spróbuj zawęzić kryteria.")
+        gate.count("degraded")
+        resp["degraded"] = True
+        return resp
+    finally:
+        gate.leave()
 
 
 @app.get("/advanced", response_class=HTMLResponse)
 async def advanced_search(request: Request):
     """Wyszukiwanie zaawansowane dla osób, które wolą ręczne filtry"""
-    fuel_types = get_distinct_values("fuel_type")
-    gearboxes = get_distinct_values("gearbox")
-    voivodeships = get_distinct_values("voivodeship")
-
-    return templates.TemplateResponse(
-        "advanced_search.html",
-        {
-            "request": request,
-            "fuel_types": fuel_types,
-            "gearboxes": gearboxes,
-            "voivodeships": voivodeships,
-        },
-    )
+    def render():
+        # listy filtrów zmieniają się tylko przy imporcie – zapytania tylko przy braku w cache
+        fuel_types = get_distinct_values("fuel_type")
+        gearboxes = get_distinct_values("gearbox")
+        voivodeships = get_distinct_values("voivodeship")
+
+        return templates.TemplateResponse(
+            "advanced_search.html",
+            {
+                "request": request,
+                "fuel_types": fuel_types,
+                "gearboxes": gearboxes,
+                "voivodeships": voivodeships,
+            },
+        )
+
+    return cached_page(request, "advanced_search.html", {}, render)
 
 
 @app.post("/advanced_results", response_class=HTMLResponse)
@@ -404,6 +483,11 @@ async def advanced_results(
     year_max: Optional[str] = Form(None),
     mileage_max: Optional[str] = Form(None),
     power_min: Optional[str] = Form(None),
+    near_city: Optional[str] = Form(None),
+    radius_km: Optional[str] = Form(None),
+    sort_by_distance: Optional[str] = Form(None),
+    make: Optional[str] = Form(None),
+    model: Optional[str] = Form(None),
 ):
     """Obsługa formularza wyszukiwania zaawansowanego"""
     price_min_f = _to_float(price_min)
@@ -412,8 +496,11 @@ async def advanced_results(
     year_max_i = _to_int(year_max)
     mileage_max_f = _to_float(mileage_max)
     power_min_f = _to_float(power_min)
+    near_city = (near_city or "").strip() or None
+    radius_km_f = _to_float(radius_km)
+    by_distance = bool(near_city and sort_by_distance)
 
-    candidates = search(
+    filters = dict(
         fuel_type=fuel_type,
         gearbox=gearbox,
         voivodeship=voivodeship,
@@ -423,19 +510,243 @@ async def advanced_results(
         year_max=year_max_i,
         mileage_max=mileage_max_f,
         power_min=power_min_f,
+        near_city=near_city,
+        radius_km=radius_km_f,
+        order_by_distance=by_distance,
+        make=(make or "").strip() or None,
+        model=(model or "").strip() or None,
     )
-    candidates = _dedup_listings(candidates)
 
-    def sort_key(car):
-        return (
-            car.price if car.price is not None else float("inf"),
-            -(car.year if car.year is not None else 0),
-            car.mileage if car.mileage is not None else float("inf"),
+    def render(limit: int = 200, degraded: bool = False):
+        candidates = search(**filters, limit=limit)
+        check_deadline()
+        candidates = _dedup_listings(candidates)
+        distances = (cities_within(near_city, radius_km_f or 0.0, voivodeship) or {}) if near_city else {}
+
+        def sort_key(car):
+            return (
+                car.price if car.price is not None else float("inf"),
+                -(car.year if car.year is not None else 0),
+                car.mileage if car.mileage is not None else float("inf"),
+            )
+
+        if by_distance:
+            candidates.sort(key=lambda car: (distances.get(car.city_id, float("inf")), sort_key(car)))
+        else:
+            candidates.sort(key=sort_key)
+
+        return templates.TemplateResponse(
+            "advanced_results.html",
+            {
+                "request": request,
+                "results": candidates[:50],
+                "total_found": len(candidates),
+                "distances": distances,
+                "degraded": degraded,
+            },
         )
 
-    candidates.sort(key=sort_key)
-
-    return templates.TemplateResponse(
-        "advanced_results.html",
-        {"request": request, "results": candidates[:50], "total_found": len(candidates)},
+    # popularne zestawy filtrów trafiają do cache stron (do następnego importu) – z cache bez limitu
+    cached = lookup_page(request, "advanced_results.html", filters)
+    gate = GATES["advanced_results"]
+    if cached is not None:
+        gate.count("served_cached")
+        return cached
+    if not gate.try_enter():
+        return HTMLResponse(
+            "<h1>Duży ruch</h1><p>Spróbuj ponownie za chwilę.</p>",
+            status_code=503, headers=gate.retry_headers(),
+        )
+    try:
+        try:
+            return await run_in_threadpool(
+                run_with_deadline, gate.budget_s, cached_page, request, "advanced_results.html", filters, render,
+            )
+        except DeadlineExceeded:
+            gate.count("deadline_missed")
+        # tryb awaryjny: mniejszy top-N, bez zapisu do cache (to nie jest pełny wynik)
+        try:
+            response = await run_in_threadpool(run_with_deadline, DEGRADED_BUDGET_S, render, DEGRADED_LIMIT, True)
+        except DeadlineExceeded:
+            gate.count("deadline_missed")
+            return HTMLResponse(
+                "<h1>Wyszukiwanie trwa zbyt długo</h1><p>Zawęź kryteria i spróbuj ponownie.</p>",
+                status_code=503, headers=gate.retry_headers(),
+            )
+        gate.count("degraded")
+        response.headers["Cache-Control"] = "no-store"
+        return response
+    finally:
+        gate.leave()
+
+
+def _parse_filters(raw: Dict[str, Any]) -> Dict[str, Any]:
+    """Filtry z JSON (liczby lub napisy) -> argumenty repo.search."""
+    spec: Dict[str, Any] = {
+        k: raw.get(k) or None for k in ("fuel_type", "gearbox", "voivodeship", "near_city", "make", "model")
+    }
+    for k in ("price_min", "price_max", "mileage_max", "power_min", "radius_km"):
+        spec[k] = _to_float(None if raw.get(k) is None else str(raw[k]))
+    for k in ("year_min", "year_max"):
+        spec[k] = _to_int(None if raw.get(k) is None else str(raw[k]))
+    return spec
+
+
+@app.post("/advanced_results/batch", response_class=JSONResponse)
+async def advanced_results_batch(request: Request):
+    """
+    Wiele wyszukiwań zaawansowanych w jednym żądaniu i jednym przebiegu po danych.
+    Body: {"specs": [{"fuel_type": ..., "price_max": ...}, ...], "limit": 50}
+    """
+    body = await request.json()
+    specs_in = body.get("specs") or []
+    limit = _to_int(str(body.get("limit", 50))) or 50
+    if not isinstance(specs_in, list) or len(specs_in) > BATCH_MAX_SPECS:
+        return JSONResponse({"error": f"'specs' musi być listą (maks. {BATCH_MAX_SPECS})"}, status_code=400)
+
+    specs = []
+    for raw in specs_in:
+        if not isinstance(raw, dict):
+            return JSONResponse({"error": "Każdy element 'specs' musi być obiektem"}, status_code=400)
+        unknown = set(raw) - set(SEARCH_FILTERS)
+        if unknown:
+            return JSONResponse({"error": f"Nieznane filtry: {sorted(unknown)}"}, status_code=400)
+        specs.append(_parse_filters(raw))
+
+    # obliczenia (i przebudowa migawki po imporcie) w puli wątków – nie blokują pętli zdarzeń
+    results = await run_in_threadpool(search_batch, specs, limit=max(1, min(limit, BATCH_MAX_LIMIT)))
+    return {"results": results}
+
+
+@app.get("/autocomplete", response_class=JSONResponse)
+async def autocomplete(q: str = "", limit: int = 8):
+    """Podpowiedzi marki/modelu (tolerancja 1 literówki i braku polskich znaków) z indeksu w pamięci."""
+    return {"query": q, "suggestions": complete(q, limit=max(1, min(limit, 20)))}
+
+
+@app.get("/overload_stats", response_class=JSONResponse)
+async def overload_stats_view():
+    """Liczniki kontroli przeciążenia na trasę (odrzucone, przekroczone terminy, tryb awaryjny) – do doboru pojemności."""
+    return overload_stats()
+
+
+# ---------- Historia cen ----------
+
+@app.get("/price_drops", response_class=JSONResponse)
+async def price_drops_view(imports: int = 1, limit: int = 100):
+    """Obniżki cen z ostatnich `imports` importów."""
+    with get_session() as s:
+        return {"drops": price_drops(s, last_imports=max(1, imports), limit=max(1, min(limit, 1000)))}
+
+
+@app.get("/listings/history", response_class=JSONResponse)
+async def listing_history_view(link: str):
+    """Historia ceny/przebiegu ogłoszenia (po linku) i czas na rynku."""
+    link_key = normalize_link(link)
+    if link_key is None:
+        return JSONResponse({"error": "Brak parametru 'link'"}, status_code=400)
+    with get_session() as s:
+        return listing_history(s, link_key)
+
+
+# ---------- Eksport CSV / NDJSON ----------
+
+# kolumny *_id eksportowane jako etykiety słownikowe (fuel_type, gearbox, city, voivodeship, make, model)
+EXPORT_COLUMNS = [
+    c.name[:-3] if c.name[:-3] in LOOKUP_MODELS else c.name
+    for c in CarListing.__table__.columns
+]
+
+
+def _format_chunk(chunk: List[Dict[str, Any]], fmt: str) -> str:
+    if fmt == "ndjson":
+        return "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in chunk)
+    buf = io.StringIO()
+    csv.DictWriter(buf, fieldnames=EXPORT_COLUMNS).writerows(chunk)
+    return buf.getvalue()
+
+
+@app.get("/export")
+async def export(request: Request, format: str = "csv"):
+    """
+    Strumieniowy eksport wszystkich pasujących (zdeduplikowanych) ogłoszeń.
+    Filtry jak w /advanced_results, przekazywane w query stringu, np. /export?format=ndjson&price_max=30000
+    """
+    if format not in ("csv", "ndjson"):
+        return JSONResponse({"error": "format musi być 'csv' lub 'ndjson'"}, status_code=400)
+    params = dict(request.query_params)
+    # literówka w nazwie filtra nie może po cichu wyeksportować całej tabeli
+    unknown = set(params) - set(SEARCH_FILTERS) - {"format"}
+    if unknown:
+        return JSONResponse({"error": f"Nieznane filtry: {sorted(unknown)}"}, status_code=400)
+    filters = _parse_filters(params)
+    chunks = stream_search(**filters)
+
+    async def body():
+        try:
+            if format == "csv":
+                yield ",".join(EXPORT_COLUMNS) + "\r\n"
+            while True:
+                # odczyt kursora w puli wątków, żeby nie blokować pętli zdarzeń
+                chunk = await run_in_threadpool(next, chunks, None)
+                if chunk is None:
+                    break
+                if await request.is_disconnected():
+                    break
+                yield _format_chunk(chunk, format)
+        finally:
+            # zamyka kursor i połączenie – przerwane pobieranie kończy zapytanie
+            await run_in_threadpool(chunks.close)
+
+    media = "text/csv; charset=utf-8" if format == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        body(),
+        media_type=media,
+        headers={"Content-Disposition": f'attachment; filename="carlistings.{format}"'},
     )
+
+
+# ---------- Zapisane wyszukiwania i powiadomienia ----------
+
+@app.post("/saved_searches", response_class=JSONResponse)
+async def saved_search_create(request: Request):
+    """Body: {"owner": "...", "name": "...", <filtry jak w /advanced_results>}"""
+    body = await request.json()
+    owner = (body.get("owner") or "").strip()
+    if not owner:
+        return JSONResponse({"error": "Brak pola 'owner'"}, status_code=400)
+    unknown = set(body) - set(SEARCH_FILTERS) - {"owner", "name"}
+    if unknown:
+        return JSONResponse({"error": f"Nieznane filtry: {sorted(unknown)}"}, status_code=400)
+    parsed = _parse_filters(body)
+    # promień wokół miasta nie jest (jeszcze) obsługiwany w zapisanych wyszukiwaniach – nie gubimy go po cichu
+    unsupported = sorted(k for k, v in parsed.items() if v is not None and k not in SavedSearch.model_fields)
+    if unsupported:
+        return JSONResponse(
+            {"error": f"Filtry nieobsługiwane w zapisanych wyszukiwaniach: {unsupported}"}, status_code=400,
+        )
+    filters = {k: v for k, v in parsed.items() if k in SavedSearch.model_fields}
+    ss = create_saved_search(owner=owner, name=body.get("name"), **filters)
+    return ss.model_dump()
+
+
+@app.get("/saved_searches", response_class=JSONResponse)
+async def saved_search_list(owner: str):
+    return [ss.model_dump() for ss in list_saved_searches(owner)]
+
+
+@app.delete("/saved_searches/{search_id}", response_class=JSONResponse)
+async def saved_search_delete(search_id: int, owner: str):
+    if not delete_saved_search(search_id, owner):
+        return JSONResponse({"error": "Nie znaleziono wyszukiwania"}, status_code=404)
+    return {"deleted": search_id}
+
+
+@app.get("/notifications", response_class=JSONResponse)
+async def notifications(owner: str, since_id: int = 0, limit: int = 100):
+    """Odpytywanie o nowe dopasowania: klient przekazuje id ostatniego widzianego powiadomienia."""
+    notes = get_notifications(owner, since_id=since_id, limit=max(1, min(limit, 500)))
+    return {
+        "notifications": [n.model_dump() for n in notes],
+        "last_id": notes[-1].id if notes else since_id,
+    }
@@ -0,0 +1,168 @@
+# app/market.py
+from typing import Dict, Iterable, Optional, Set, Tuple
+import pandas as pd
+from sqlmodel import select, delete
+from sqlalchemy import or_
+from .models import CarListing, MarketSegment
+from .db import engine, get_session
+
+# Szerokość kubełków segmentu
+YEAR_BUCKET = 3          # lata
+MILEAGE_BUCKET = 50000   # km
+POWER_BAND = 50          # KM
+MIN_SEGMENT_SIZE = 5     # mniejsze segmenty nie dają wiarygodnych percentyli
+
+SegmentKey = Tuple[int, int, int, int]
+
+# Cache w pamięci: klucz segmentu -> (p10, p50, p90); ładowany leniwie z tabeli marketsegment
+_MARKET: Dict[SegmentKey, Tuple[float, float, float]] = {}
+_loaded = False
+
+
+def segment_key(year, mileage, fuel_type_id, power_hp) -> Optional[SegmentKey]:
+    """
+    Klucz segmentu rynkowego. Bez rocznika lub przebiegu nie da się ocenić ceny -> None.
+    Brak mocy lub paliwa trafia do osobnego pasma/kodu -1.
+    """
+    if year is None or mileage is None or pd.isna(year) or pd.isna(mileage):
+        return None
+    power = -1 if power_hp is None or pd.isna(power_hp) else int(power_hp) // POWER_BAND
+    fuel = -1 if fuel_type_id is None or pd.isna(fuel_type_id) else int(fuel_type_id)
+    return (int(year) // YEAR_BUCKET, int(mileage) // MILEAGE_BUCKET, fuel, power)
+
+
+def segments_of(listings: Iterable) -> Set[SegmentKey]:
+    """Zbiór segmentów dotkniętych przez podane ogłoszenia (obiekty lub słowniki)."""
+    out = set()
+    for c in listings:
+        get = c.get if isinstance(c, dict) else lambda k: getattr(c, k, None)
+        key = segment_key(get("year"), get("mileage"), get("fuel_type_id"), get("power_hp"))
+        if key is not None:
+            out.add(key)
+    return out
+
+
+def _load_frame(segments: Optional[Set[SegmentKey]]) -> pd.DataFrame:
+    cols = [CarListing.price, CarListing.year, CarListing.mileage, CarListing.fuel_type_id, CarListing.power_hp]
+    q = select(*cols).where(CarListing.price > 0, CarListing.year.is_not(None), CarListing.mileage.is_not(None))
+    if segments is not None:
+        # wstępne zawężenie w SQL: zakres roczników + paliwa; dokładny filtr po kluczu niżej
+        years = [k[0] for k in segments]
+        q = q.where(CarListing.year >= min(years) * YEAR_BUCKET,
+                    CarListing.year < (max(years) + 1) * YEAR_BUCKET)
+        fuels = {k[2] for k in segments}
+        conds = [CarListing.fuel_type_id.in_([f for f in fuels if f != -1])]
+        if -1 in fuels:
+            conds.append(CarListing.fuel_type_id.is_(None))
+        q = q.where(or_(*conds))
+    df = pd.read_sql(q, engine)
+    if df.empty:
+        return df
+    df["fuel_type_id"] = df["fuel_type_id"].fillna(-1).astype(int)
+    df["year_bucket"] = df["year"].astype(int) // YEAR_BUCKET
+    df["mileage_bucket"] = df["mileage"].astype(int) // MILEAGE_BUCKET
+    df["power_band"] = (df["power_hp"] // POWER_BAND).fillna(-1).astype(int)
+    return df
+
+
+def refresh_market_index(segments: Optional[Iterable[SegmentKey]] = None) -> int:
+    """
+    Przelicza tabele percentyli cen. Uruchamiane po imporcie.
+      - segments=None -> pełna przebudowa,
+      - segments=[...] -> tylko wskazane segmenty (aktualizacja przyrostowa).
+    Zwraca liczbę zapisanych segmentów.
+    """
+    global _loaded
+    seg_set = set(segments) if segments is not None else None
+    if seg_set is not None and not seg_set:
+        return 0
+
+    df = _load_frame(seg_set)
+    keys = ["year_bucket", "mileage_bucket", "fuel_type_id", "power_band"]
+    stats = pd.DataFrame()
+    if not df.empty:
+        if seg_set is not None:
+            idx = pd.MultiIndex.from_frame(df[keys])
+            df = df[idx.isin(list(seg_set))]
+        g = df.groupby(keys)["price"]
+        stats = g.quantile([0.1, 0.5, 0.9]).unstack()
+        stats["n"] = g.size()
+        stats = stats[stats["n"] >= MIN_SEGMENT_SIZE]
+
+    with get_session() as s:
+        if seg_set is None:
+            s.exec(delete(MarketSegment))
+        else:
+            for k in seg_set:
+                row = s.get(MarketSegment, k)
+                if row is not None:
+                    s.delete(row)
+        s.flush()
+        for k, r in stats.iterrows():
+            s.add(MarketSegment(year_bucket=k[0], mileage_bucket=k[1], fuel_type_id=k[2], power_band=k[3],
+                                n=int(r["n"]), p10=float(r[0.1]), p50=float(r[0.5]), p90=float(r[0.9])))
+        s.commit()
+
+    if seg_set is None:
+        _MARKET.clear()
+    else:
+        for k in seg_set:
+            _MARKET.pop(k, None)
+    for k, r in stats.iterrows():
+        _MARKET[tuple(k)] = (float(r[0.1]), float(r[0.5]), float(r[0.9]))
+    _loaded = True
+    print(f"[market] Zaktualizowano segmentów: {len(stats)}")
+    return len(stats)
+
+
+def refresh_after_import(touched: Iterable) -> int:
+    """
+    Aktualizacja po imporcie: przeliczane są tylko segmenty dotknięte importem (wiersze „touched”
+    z db.seed_from_csv – stare i nowe wersje zmienionych oraz usunięte ogłoszenia).
+    Pusta tabela marketsegment (pierwszy import, zmiana schematu) -> pełna przebudowa.
+    """
+    if not _loaded:
+        load_market_index()
+    if not _MARKET:
+        return refresh_market_index()
+    return refresh_market_index(segments_of(touched))
+
+
+def load_market_index() -> None:
+    """Wczytuje tabelę marketsegment do pamięci (np. po restarcie bez ponownego importu)."""
+    global _loaded
+    with get_session() as s:
+        rows = s.exec(select(MarketSegment)).all()
+    _MARKET.clear()
+    for r in rows:
+        _MARKET[(r.year_bucket, r.mileage_bucket, r.fuel_type_id, r.power_band)] = (r.p10, r.p50, r.p90)
+    _loaded = True
+
+
+def market_stats(car) -> Optional[Tuple[float, float, float]]:
+    """(p10, p50, p90) ceny dla segmentu auta albo None, gdy segment nieznany. Lookup O(1)."""
+    if not _loaded:
+        load_market_index()
+    key = segment_key(getattr(car, "year", None), getattr(car, "mileage", None),
+                      getattr(car, "fuel_type_id", None), getattr(car, "power_hp", None))
+    return _MARKET.get(key) if key is not None else None
+
+
+def below_market_score(car) -> float:
+    """
+    Ocena „okazji” 0..1 względem rynku dla segmentu:
+      cena <= p10 -> 1.0, cena == p50 -> 0.5, cena >= p90 -> 0.0 (liniowo pomiędzy).
+    Brak ceny lub segmentu -> 0.5 (neutralnie).
+    """
+    price = getattr(car, "price", None)
+    stats = market_stats(car)
+    if price is None or stats is None:
+        return 0.5
+    p10, p50, p90 = stats
+    if price <= p10:
+        return 1.0
+    if price >= p90:
+        return 0.0
+    if price <= p50:
+        return 1.0 - 0.5 * (price - p10) / ((p50 - p10) or 1.0)
+    return 0.5 - 0.5 * (price - p50) / ((p90 - p50) or 1.0)
@@ -1,6 +1,53 @@
-from typing import Optional
+from datetime import datetime
+from typing import Dict, Optional
+from pydantic import computed_field
 from sqlmodel import SQLModel, Field
 
+# Słowniki kod -> etykieta dla kolumn kategorycznych; wypełniane przez app.categories
+CATEGORY_LABELS: Dict[str, Dict[int, str]] = {
+    "fuel_type": {},
+    "gearbox": {},
+    "city": {},
+    "voivodeship": {},
+    "make": {},
+    "model": {},
+}
+
+
+class FuelType(SQLModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    name: str = Field(index=True, unique=True)
+
+
+class Gearbox(SQLModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    name: str = Field(index=True, unique=True)
+
+
+class City(SQLModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    name: str = Field(index=True, unique=True)
+    # współrzędne z lokalnego gazetera (app/data/gazetteer_pl.csv); None = nie znaleziono
+    lat: Optional[float] = Field(default=None)
+    lon: Optional[float] = Field(default=None)
+
+
+class Voivodeship(SQLModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    name: str = Field(index=True, unique=True)
+
+
+class Make(SQLModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    name: str = Field(index=True, unique=True)
+
+
+class CarModel(SQLModel, table=True):
+    """Model z marką w nazwie (np. „Toyota Corolla”), żeby był unikalny między markami."""
+    id: Optional[int] = Field(default=None, primary_key=True)
+    name: str = Field(index=True, unique=True)
+
+
 class CarListing(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     title: Optional[str] = Field(default=None, index=True)
@@ -11,8 +58,111 @@ class CarListing(SQLModel, table=True):
     year: Optional[int] = Field(default=None, index=True)
     power_hp: Optional[float] = Field(default=None, index=True, alias="power[HP]")
     capacity_cm3: Optional[float] = Field(default=None, index=True, alias="capacity[cm3]")
-    fuel_type: Optional[str] = Field(default=None, index=True)
-    gearbox: Optional[str] = Field(default=None, index=True)
-    city: Optional[str] = Field(default=None, index=True)
-    voivodeship: Optional[str] = Field(default=None, index=True)
+    fuel_type_id: Optional[int] = Field(default=None, index=True, foreign_key="fueltype.id")
+    gearbox_id: Optional[int] = Field(default=None, index=True, foreign_key="gearbox.id")
+    city_id: Optional[int] = Field(default=None, index=True, foreign_key="city.id")
+    voivodeship_id: Optional[int] = Field(default=None, index=True, foreign_key="voivodeship.id")
+    # marka/model wyciągnięte z tytułu przy imporcie
+    make_id: Optional[int] = Field(default=None, index=True, foreign_key="make.id")
+    model_id: Optional[int] = Field(default=None, index=True, foreign_key="carmodel.id")
     other_info: Optional[str] = Field(default=None)
+
+    # Etykiety kategorii (szablony, JSON) – rozwiązywane z CATEGORY_LABELS bez zapytań do bazy
+    @computed_field
+    @property
+    def fuel_type(self) -> Optional[str]:
+        return CATEGORY_LABELS["fuel_type"].get(self.fuel_type_id)
+
+    @computed_field
+    @property
+    def gearbox(self) -> Optional[str]:
+        return CATEGORY_LABELS["gearbox"].get(self.gearbox_id)
+
+    @computed_field
+    @property
+    def city(self) -> Optional[str]:
+        return CATEGORY_LABELS["city"].get(self.city_id)
+
+    @computed_field
+    @property
+    def voivodeship(self) -> Optional[str]:
+        return CATEGORY_LABELS["voivodeship"].get(self.voivodeship_id)
+
+    @computed_field
+    @property
+    def make(self) -> Optional[str]:
+        return CATEGORY_LABELS["make"].get(self.make_id)
+
+    @computed_field
+    @property
+    def model(self) -> Optional[str]:
+        return CATEGORY_LABELS["model"].get(self.model_id)
+
+
+class MarketSegment(SQLModel, table=True):
+    """Percentyle cen (p10/p50/p90) dla segmentu rocznik × przebieg × paliwo × moc."""
+    year_bucket: int = Field(primary_key=True)
+    mileage_bucket: int = Field(primary_key=True)
+    fuel_type_id: int = Field(default=-1, primary_key=True)  # -1 = brak paliwa
+    power_band: int = Field(primary_key=True)
+    n: int = 0
+    p10: float = 0.0
+    p50: float = 0.0
+    p90: float = 0.0
+
+
+class SavedSearch(SQLModel, table=True):
+    """Zapisane wyszukiwanie użytkownika – te same filtry co repo.search."""
+    id: Optional[int] = Field(default=None, primary_key=True)
+    owner: str = Field(index=True)
+    name: Optional[str] = Field(default=None)
+    fuel_type: Optional[str] = Field(default=None)
+    gearbox: Optional[str] = Field(default=None)
+    voivodeship: Optional[str] = Field(default=None)
+    price_min: Optional[float] = Field(default=None)
+    price_max: Optional[float] = Field(default=None)
+    year_min: Optional[int] = Field(default=None)
+    year_max: Optional[int] = Field(default=None)
+    mileage_max: Optional[float] = Field(default=None)
+    power_min: Optional[float] = Field(default=None)
+    # etykiety kanoniczne jak w /autocomplete (np. "Toyota", "Toyota Corolla")
+    make: Optional[str] = Field(default=None)
+    model: Optional[str] = Field(default=None)
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
+
+class Notification(SQLModel, table=True):
+    """Nowe lub zmienione ogłoszenie pasujące do zapisanego wyszukiwania."""
+    id: Optional[int] = Field(default=None, primary_key=True)
+    saved_search_id: int = Field(index=True, foreign_key="savedsearch.id")
+    owner: str = Field(index=True)
+    # znormalizowany link (jak pricehistory.link_key) – id z carlisting zmieniają się przy każdym imporcie
+    link_key: Optional[str] = Field(default=None, index=True)
+    link: Optional[str] = Field(default=None)
+    title: Optional[str] = Field(default=None)
+    price: Optional[float] = Field(default=None)
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
+
+class ImportRun(SQLModel, table=True):
+    """Jedno uruchomienie importu (numeracja importów dla historii cen)."""
+    id: Optional[int] = Field(default=None, primary_key=True)
+    source: Optional[str] = Field(default=None)
+    started_at: datetime = Field(default_factory=datetime.utcnow)
+    rows: int = 0
+    changed: int = 0
+
+
+class PriceHistory(SQLModel, table=True):
+    """
+    Historia ceny/przebiegu ogłoszenia – tylko dopisywana, jeden wiersz na zmianę (nie na import).
+    prev_price pozwala znaleźć obniżki bez łączenia z poprzednim wierszem.
+    removed: ogłoszenia nie ma w imporcie import_id (cena/przebieg jak w ostatnim wpisie).
+    """
+    id: Optional[int] = Field(default=None, primary_key=True)
+    link_key: str = Field(index=True)
+    import_id: int = Field(index=True, foreign_key="importrun.id")
+    price: Optional[float] = Field(default=None)
+    mileage: Optional[float] = Field(default=None)
+    prev_price: Optional[float] = Field(default=None)
+    removed: bool = Field(default=False)
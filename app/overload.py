@@ -0,0 +1,91 @@
+# app/overload.py
+import time
+from typing import Callable, Dict
+
+from sqlalchemy.exc import OperationalError
+
+# progress handler przerywający zapytania po terminie jest rejestrowany w db (przy create_engine)
+from .db import QUERY_DEADLINE
+
+
+class DeadlineExceeded(Exception):
+    """Żądanie przekroczyło budżet czasu (zapytanie SQLite przerwane lub termin minął między etapami)."""
+
+
+class RouteGate:
+    """
+    Limit równoległych żądań jednej trasy (kontrola dopuszczenia) i budżet czasu na żądanie.
+    try_enter()/leave() wołane z pętli zdarzeń, więc zwykły licznik wystarcza.
+    Liczniki (do doboru pojemności): admitted, shed, deadline_missed, degraded, served_cached.
+    """
+
+    def __init__(self, name: str, max_in_flight: int, budget_s: float, retry_after_s: int = 2):
+        self.name = name
+        self.max_in_flight = max_in_flight
+        self.budget_s = budget_s
+        self.retry_after_s = retry_after_s
+        self.in_flight = 0
+        self.counters: Dict[str, int] = {
+            "admitted": 0, "shed": 0, "deadline_missed": 0, "degraded": 0, "served_cached": 0,
+        }
+
+    def try_enter(self) -> bool:
+        if self.in_flight >= self.max_in_flight:
+            self.counters["shed"] += 1
+            return False
+        self.in_flight += 1
+        self.counters["admitted"] += 1
+        return True
+
+    def leave(self) -> None:
+        self.in_flight -= 1
+
+    def count(self, name: str) -> None:
+        self.counters[name] += 1
+
+    def retry_headers(self) -> Dict[str, str]:
+        return {"Retry-After": str(self.retry_after_s)}
+
+    def stats(self) -> Dict:
+        return {
+            "in_flight": self.in_flight, "max_in_flight": self.max_in_flight,
+            "budget_s": self.budget_s, **self.counters,
+        }
+
+
+# Trasy z pełnym potokiem wyszukaj -> deduplikuj -> oceń -> renderuj
+GATES: Dict[str, RouteGate] = {
+    "chat_search": RouteGate("chat_search", max_in_flight=4, budget_s=2.0),
+    "advanced_results": RouteGate("advanced_results", max_in_flight=8, budget_s=2.0),
+}
+
+# Tryb awaryjny po przekroczeniu terminu: mniejszy top-N i krótszy budżet
+DEGRADED_LIMIT = 40
+DEGRADED_BUDGET_S = 1.0
+
+
+def check_deadline() -> None:
+    """Przerywa etap w Pythonie (deduplikacja, ocena), gdy termin żądania już minął."""
+    deadline = QUERY_DEADLINE.get()
+    if deadline is not None and time.monotonic() > deadline:
+        raise DeadlineExceeded()
+
+
+def run_with_deadline(budget_s: float, fn: Callable, *args, **kwargs):
+    """
+    Wywołuje fn z terminem budget_s sekund (wołać w wątku roboczym, np. przez run_in_threadpool).
+    Zapytanie SQLite, które przekroczy termin, jest przerywane przez progress handler -> DeadlineExceeded.
+    """
+    token = QUERY_DEADLINE.set(time.monotonic() + budget_s)
+    try:
+        return fn(*args, **kwargs)
+    except OperationalError as e:
+        if "interrupted" in str(e.orig):
+            raise DeadlineExceeded() from e
+        raise
+    finally:
+        QUERY_DEADLINE.reset(token)
+
+
+def overload_stats() -> Dict[str, Dict]:
+    return {name: gate.stats() for name, gate in GATES.items()}
@@ -1,15 +1,39 @@
 # app/repo.py
-from typing import Iterable, Optional, List
+import threading
+from typing import Any, Dict, Iterable, Iterator, Optional, List, Tuple
+import numpy as np
+import pandas as pd
+from sqlalchemy import case, false
 from sqlmodel import select
-from .models import CarListing
-from .db import get_session
+from .models import CATEGORY_LABELS, CarListing
+from .db import data_version, engine, get_session
+from .categories import LOOKUP_MODELS, code
+from .geo import cities_within
+
+# Nazwy filtrów akceptowane przez search / search_batch
+SEARCH_FILTERS = (
+    "fuel_type", "gearbox", "voivodeship",
+    "price_min", "price_max", "year_min", "year_max",
+    "mileage_max", "power_min", "near_city", "radius_km", "make", "model",
+)
+
+# search_batch: pełne wiersze top-N pobierane po id w porcjach (limit parametrów SQLite)
+BATCH_FETCH_IDS = 5000
 
 
 def get_distinct_values(column: str, limit: int = 200) -> List[str]:
     """
     Zwraca posortowaną listę unikalnych wartości dla wskazanej kolumny modelu CarListing.
     Uwaga: `column` musi być nazwą atrybutu w CarListing (np. "fuel_type", "gearbox", "voivodeship").
+    Kolumny kategoryczne czytane są po kodach (indeks na *_id) i tłumaczone na etykiety.
     """
+    if column in LOOKUP_MODELS:
+        col = getattr(CarListing, f"{column}_id")
+        with get_session() as s:
+            codes = s.exec(select(col).where(col.is_not(None)).distinct()).all()
+        labels = CATEGORY_LABELS[column]
+        return sorted(labels[c] for c in codes if c in labels)[:limit]
+
     col = getattr(CarListing, column)
     with get_session() as s:
         values = s.exec(
@@ -20,6 +44,59 @@ def get_distinct_values(column: str, limit: int = 200) -> List[str]:
     return vals[:limit]
 
 
+def _conditions(
+    *,
+    fuel_type: Optional[str] = None,
+    gearbox: Optional[str] = None,
+    voivodeship: Optional[str] = None,
+    price_min: Optional[float] = None,
+    price_max: Optional[float] = None,
+    year_min: Optional[int] = None,
+    year_max: Optional[int] = None,
+    mileage_max: Optional[float] = None,
+    power_min: Optional[float] = None,
+    near_city: Optional[str] = None,
+    radius_km: Optional[float] = None,
+    make: Optional[str] = None,
+    model: Optional[str] = None,
+) -> list:
+    """Warunki WHERE dla filtrów wyszukiwania (wspólne dla search i search_batch)."""
+    conds = []
+
+    # --- filtry kategoryczne (po kodach słownikowych; nieznana wartość -> brak wyników) ---
+    # z near_city województwo wskazuje tylko, o którą miejscowość chodzi – promień przekracza granice województw
+    for column, value in (("fuel_type", fuel_type), ("gearbox", gearbox),
+                          ("voivodeship", None if near_city else voivodeship), ("make", make), ("model", model)):
+        if value:
+            c = code(column, value)
+            conds.append(getattr(CarListing, f"{column}_id") == c if c is not None else false())
+
+    # --- filtry liczbowe ---
+    if price_min is not None:
+        conds.append(CarListing.price >= price_min)
+    if price_max is not None:
+        conds.append(CarListing.price <= price_max)
+
+    if year_min is not None:
+        conds.append(CarListing.year >= year_min)
+    if year_max is not None:
+        conds.append(CarListing.year <= year_max)
+
+    # ⬇ kluczowy filtr – maksymalny przebieg
+    if mileage_max is not None:
+        conds.append(CarListing.mileage <= mileage_max)
+
+    if power_min is not None:
+        conds.append(CarListing.power_hp >= power_min)
+
+    # --- promień wokół miejscowości: siatka -> lista city_id (bez promienia = ta sama miejscowość) ---
+    if near_city:
+        within = cities_within(near_city, radius_km or 0.0, voivodeship)
+        conds.append(CarListing.city_id.in_(list(within)) if within else false())
+
+    return conds
+
+
 def search(
     *,
     fuel_type: Optional[str] = None,
@@ -31,8 +108,13 @@ def search(
     year_max: Optional[int] = None,
     mileage_max: Optional[float] = None,
     power_min: Optional[float] = None,
+    near_city: Optional[str] = None,
+    radius_km: Optional[float] = None,
+    make: Optional[str] = None,
+    model: Optional[str] = None,
     limit: int = 200,
     order_by_price_asc: bool = False,
+    order_by_distance: bool = False,
 ) -> Iterable[CarListing]:
     """
     Filtruje oferty wg przekazanych kryteriów.
@@ -41,40 +123,192 @@ def search(
     Parametry:
       - limit: maksymalna liczba rekordów (dla bezpieczeństwa UI)
       - order_by_price_asc: True -> sortuj rosnąco po cenie, False -> brak sortowania (kolejność z bazy)
+      - near_city / radius_km: tylko ogłoszenia z miejscowości w promieniu radius_km km od near_city
+        (voivodeship rozróżnia wtedy miejscowości o tej samej nazwie, nie filtruje ogłoszeń)
+      - order_by_distance: True (z near_city) -> najbliższe najpierw
+      - make / model: etykiety z /autocomplete (np. "Toyota", "Toyota Corolla") – filtr po kodach
     """
     with get_session() as s:
-        q = select(CarListing)
-
-        # --- filtry kategoryczne ---
-        if fuel_type:
-            q = q.where(CarListing.fuel_type == fuel_type)
-        if gearbox:
-            q = q.where(CarListing.gearbox == gearbox)
-        if voivodeship:
-            q = q.where(CarListing.voivodeship == voivodeship)
-
-        # --- filtry liczbowe ---
-        if price_min is not None:
-            q = q.where(CarListing.price >= price_min)
-        if price_max is not None:
-            q = q.where(CarListing.price <= price_max)
-
-        if year_min is not None:
-            q = q.where(CarListing.year >= year_min)
-        if year_max is not None:
-            q = q.where(CarListing.year <= year_max)
-
-        # ⬇ kluczowy filtr – maksymalny przebieg
-        if mileage_max is not None:
-            q = q.where(CarListing.mileage <= mileage_max)
-
-        if power_min is not None:
-            q = q.where(CarListing.power_hp >= power_min)
+        q = select(CarListing).where(*_conditions(
+            fuel_type=fuel_type, gearbox=gearbox, voivodeship=voivodeship,
+            price_min=price_min, price_max=price_max, year_min=year_min, year_max=year_max,
+            mileage_max=mileage_max, power_min=power_min,
+            near_city=near_city, radius_km=radius_km, make=make, model=model,
+        ))
 
         # --- sortowanie / limit ---
+        if order_by_distance and near_city:
+            within = cities_within(near_city, radius_km or 0.0, voivodeship)
+            if within:
+                q = q.order_by(case(within, value=CarListing.city_id))
         if order_by_price_asc:
             q = q.order_by(CarListing.price.asc())
 
         q = q.limit(limit)
 
         return s.exec(q).all()
+
+
+def stream_search(chunk_size: int = 1000, **filters) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Generator paczek (list słowników) wszystkich pasujących ogłoszeń.
+    Kursor po stronie serwera (stream_results) bez ORDER BY – wiersze w kolejności rowid lub
+    indeksu filtra, bez sortowania; pamięć stała. Deduplikacji nie ma: import zostawia jeden
+    wiersz na znormalizowany link (db.seed_from_csv).
+    Zamknięcie generatora (np. rozłączenie klienta) przerywa zapytanie.
+    """
+    table = CarListing.__table__
+    columns = list(table.columns.keys())
+    q = select(table).where(*_conditions(**filters))
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=chunk_size).execute(q)
+        try:
+            for part in result.partitions():
+                yield [_row_with_labels(row, columns) for row in part]
+        finally:
+            result.close()
+
+
+def _row_with_labels(row, columns: List[str]) -> Dict[str, Any]:
+    """Wiersz carlisting (kolumny w kolejności `columns`) -> słownik z etykietami zamiast kodów *_id."""
+    r = dict(zip(columns, row))
+    for column in LOOKUP_MODELS:
+        r[column] = CATEGORY_LABELS[column].get(r.pop(f"{column}_id"))
+    return r
+
+
+# Filtry search_batch rozwiązywane przez listy pozycji (wspólne dla grupy zestawów) i zakresy na migawce
+BATCH_CATEGORICAL = ("fuel_type", "gearbox", "voivodeship", "make", "model")
+BATCH_BOUNDS = (
+    ("year_min", "year", np.greater_equal), ("year_max", "year", np.less_equal),
+    ("mileage_max", "mileage", np.less_equal), ("power_min", "power_hp", np.greater_equal),
+)
+NO_MATCH = -1  # kod dla nieznanej etykiety – żaden wiersz go nie ma
+
+# Migawka carlisting dla search_batch: (wersja danych, kolumny numpy, listy pozycji (kolumna, kod) -> pozycje)
+_snapshot: Optional[Tuple[int, Dict[str, np.ndarray], Dict[Tuple[str, int], np.ndarray]]] = None
+_snapshot_lock = threading.Lock()
+
+
+def _batch_snapshot() -> Tuple[Dict[str, np.ndarray], Dict[Tuple[str, int], np.ndarray]]:
+    """
+    Wąskie kolumny (id + kolumny filtrów) posortowane jak /advanced_results (cena rosnąco, brak ceny
+    na końcu, rocznik malejąco, przebieg rosnąco), po jednym wierszu na znormalizowany link (pierwszy
+    w tym porządku). Budowana raz na wersję danych (db.data_version, zmienia się tylko przy imporcie).
+    Listy pozycji kodów kategorii dopisywane leniwie przez _group_rows.
+    """
+    global _snapshot
+    with _snapshot_lock:
+        version = data_version()
+        if _snapshot is not None and _snapshot[0] == version:
+            return _snapshot[1], _snapshot[2]
+        cols = [CarListing.id, CarListing.link, CarListing.price, CarListing.year, CarListing.mileage,
+                CarListing.power_hp, CarListing.city_id]
+        cols += [getattr(CarListing, f"{c}_id") for c in BATCH_CATEGORICAL]
+        df = pd.read_sql(select(*cols), engine)
+        for col in ("price", "year", "mileage", "power_hp"):
+            df[col] = df[col].astype(float)
+        df["_year_desc"] = -df["year"].fillna(0)
+        df = df.sort_values(["price", "_year_desc", "mileage"], na_position="last", kind="stable")
+        # dedup raz dla całej migawki; ogłoszenia bez linku zostają wszystkie (bez zlewania)
+        link_key = df.pop("link").astype("string").str.strip().str.rstrip("/").str.lower()
+        dup = (link_key.notna() & (link_key != "") & link_key.duplicated()).to_numpy(dtype=bool)
+        arrays = {c: df[c].to_numpy()[~dup] for c in df.columns if c != "_year_desc"}
+        _snapshot = (version, arrays, {})
+        return arrays, _snapshot[2]
+
+
+def _group_key(spec: Dict[str, Any]) -> Tuple:
+    """Klucz grupy zestawów o tych samych filtrach kategorycznych i tym samym promieniu."""
+    codes = []
+    for column in BATCH_CATEGORICAL:
+        if column == "voivodeship" and spec.get("near_city"):
+            codes.append(None)  # województwo tylko lokalizuje near_city (jak w _conditions)
+            continue
+        c = code(column, spec[column]) if spec.get(column) else None
+        codes.append(NO_MATCH if c is None and spec.get(column) else c)
+    near = (spec["near_city"], spec.get("radius_km") or 0.0, spec.get("voivodeship")) if spec.get("near_city") else None
+    return tuple(codes), near
+
+
+def _group_rows(arrays: Dict[str, np.ndarray], postings: Dict, key: Tuple) -> np.ndarray:
+    """Pozycje migawki (rosnąco, czyli w porządku cenowym) spełniające filtry kategoryczne grupy."""
+    codes, near = key
+    filters = [(column, c) for column, c in zip(BATCH_CATEGORICAL, codes) if c is not None]
+    for f in filters:
+        if f not in postings:
+            postings[f] = np.flatnonzero(arrays[f"{f[0]}_id"] == f[1])
+    # najkrótsza lista pozycji, pozostałe filtry sprawdzane tylko na jej pozycjach
+    filters.sort(key=lambda f: len(postings[f]))
+    rows = postings[filters[0]] if filters else np.arange(len(arrays["id"]))
+    for column, c in filters[1:]:
+        rows = rows[arrays[f"{column}_id"][rows] == c]
+    if near is not None:
+        within = cities_within(*near) or {}
+        rows = rows[np.isin(arrays["city_id"][rows], list(within))]
+    return rows
+
+
+def _spec_rows(arrays: Dict[str, np.ndarray], rows: np.ndarray, prices: np.ndarray,
+               spec: Dict[str, Any]) -> np.ndarray:
+    """
+    Pozycje pasujące do zestawu w obrębie grupy: zakres ceny przez searchsorted (ceny grupy są
+    posortowane, brak ceny na końcu), pozostałe zakresy maską tylko na tym wycinku.
+    """
+    price_min, price_max = spec.get("price_min"), spec.get("price_max")
+    if price_min is not None or price_max is not None:
+        # NaN nie spełnia filtra – tak samo jak NULL w SQL
+        priced = prices[:np.searchsorted(prices, np.nan)]
+        lo = np.searchsorted(priced, float(price_min), "left") if price_min is not None else 0
+        hi = np.searchsorted(priced, float(price_max), "right") if price_max is not None else len(priced)
+        rows = rows[lo:max(lo, hi)]
+    m = None
+    for key, col, op in BATCH_BOUNDS:
+        if spec.get(key) is not None:
+            hit = op(arrays[col][rows], float(spec[key]))
+            m = hit if m is None else m & hit
+    return rows if m is None else rows[m]
+
+
+def search_batch(specs: List[Dict[str, Any]], limit: int = 50) -> List[Dict[str, Any]]:
+    """
+    Wykonuje wiele zestawów filtrów na migawce w pamięci (_batch_snapshot, jedna na import).
+    Zestawy grupowane po filtrach kategorycznych (i promieniu): pozycje grupy liczone raz
+    z list pozycji kodów, a każdy zestaw zawęża je zakresem ceny (searchsorted) i maską pozostałych
+    zakresów – koszt zestawu zależy od wielkości jego grupy, nie całej tabeli.
+    Pełne wiersze top-N wszystkich zestawów pobierane z bazy po id.
+
+    Zwraca listę {"total": int, "results": [dict, ...]} w kolejności `specs`.
+    """
+    if not specs:
+        return []
+    arrays, postings = _batch_snapshot()
+    ids = arrays["id"]
+
+    groups: Dict[Tuple, List[int]] = {}
+    for i, spec in enumerate(specs):
+        groups.setdefault(_group_key(spec), []).append(i)
+    tops: List[List[int]] = [[] for _ in specs]
+    totals = [0] * len(specs)
+    for key, members in groups.items():
+        group = _group_rows(arrays, postings, key)
+        prices = arrays["price"][group]
+        for i in members:
+            keep = _spec_rows(arrays, group, prices, specs[i])
+            totals[i] = int(len(keep))
+            tops[i] = ids[keep[:limit]].tolist()
+
+    table = CarListing.__table__
+    columns = list(table.columns.keys())
+    wanted = sorted({i for top in tops for i in top})
+    rows: Dict[int, Dict[str, Any]] = {}
+    with engine.connect() as conn:
+        for start in range(0, len(wanted), BATCH_FETCH_IDS):
+            chunk = wanted[start:start + BATCH_FETCH_IDS]
+            for row in conn.execute(select(table).where(table.c.id.in_(chunk))):
+                r = _row_with_labels(row, columns)
+                rows[r["id"]] = r
+    return [
+        {"total": total, "results": [rows[i] for i in top if i in rows]}
+        for total, top in zip(totals, tops)
+    ]